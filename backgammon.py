@@ -1,5 +1,4 @@
 import random
-import operator
 
 import color
 
@@ -31,8 +30,13 @@ class Piece:
 
 
 class Point:
-    def __init__(self, number):
-        self._pieces = []
+    """A read-only view of one point of a `Board`.
+
+    The board itself keeps only piece counters; points and pieces are
+    built on demand for the graphic client.
+    """
+    def __init__(self, board, number):
+        self._board = board
         self.number = number
 
     def __repr__(self):
@@ -64,53 +68,66 @@ class Point:
 
     @property
     def pieces(self):
-        return tuple(self._pieces)
-
-    def push(self, piece):
-        if piece not in self._pieces:
-            self._pieces.append(piece)
-            if self.number not in {0, 25}:
-                assert {p.color for p in self.pieces} == {piece.color}, \
-                    'Only pieces of same color allowed in a point'
-
-    def pop(self):
-        assert self._pieces, 'No pieces at this Point'
-        return self._pieces.pop()
+        return self._board.point_pieces(self.number)
 
     def blocked(self, piece_color):
-        return (self.number not in {0, 25} and
-                piece_color != self.color and
-                len(self._pieces) > 1)
+        return self._board.blocked(self.number, piece_color)
 
     @property
     def color(self):
-        color_ = None
-        if self._pieces:
-            colors = {p.color for p in self._pieces}
-            if self.number == 0 and color.WHITE in colors:
-                color_ = color.WHITE
-            elif self.number == 25 and color.RED in colors:
-                color_ = color.RED
-            elif len(colors) == 1:
-                color_ = self._pieces[0].color
-            else:
-                raise ValueError('More than on color in one point')
-        return color_
+        return self._board.point_color(self.number)
+
+
+PIECES = {
+    piece_color: tuple(Piece(piece_color, n) for n in range(1, 16))
+    for piece_color in (color.WHITE, color.RED)
+}
 
-    def clear(self):
-        self._pieces = []
+# Zobrist keys are seeded so equal positions hash equally in every process.
+_zobrist_random = random.Random(0x6e6574)
+ZOBRIST_POINTS = tuple(
+    tuple(_zobrist_random.getrandbits(64) for _ in range(31))
+    for _ in range(26)
+)
+ZOBRIST_OFF = {
+    piece_color: tuple(_zobrist_random.getrandbits(64) for _ in range(16))
+    for piece_color in (color.WHITE, color.RED)
+}
 
 
 class Board:
+    """Backgammon board stored as a signed counter per point.
+
+    `counts[1..24]` are positive for white and negative for red pieces,
+    `counts[0]` is the white bar and `counts[25]` is the red bar (negative),
+    so every slot is a point number of the old object board. Borne off
+    pieces are counted apart, because they share 0 and 25 with the bars.
+    """
     def __init__(self):
-        self._points = tuple(Point(i) for i in range(26))
+        self._counts = [0] * 26
+        self._off = {color.WHITE: 0, color.RED: 0}
+        self._hash = 0
+        self._pips = {color.WHITE: 0, color.RED: 0}
+        self._home = {color.WHITE: 0, color.RED: 0}
+        self._points = None
         self.on_start()
 
     def __repr__(self):
         return f'Board{self.points}'
 
+    @property
+    def counts(self):
+        return tuple(self._counts)
+
+    @property
+    def position_hash(self):
+        """64 bit Zobrist hash of the position, kept up to date by `move`."""
+        return self._hash
+
     @property
     def points(self):
+        if self._points is None:
+            self._points = tuple(Point(self, i) for i in range(26))
         return self._points
 
     def on_start(self):
@@ -119,34 +136,69 @@ class Board:
         self._clear_points()
         self._on_start(color.WHITE, white_start_state)
         self._on_start(color.RED, red_start_state)
+        self._hash = self._compute_hash()
+        self._count_pieces()
+
+    def set_counts(self, counts):
+        """Set a position given as in `counts`, the rest is borne off."""
+        assert len(counts) == 26, f'There must be 26 counters: {counts}'
+        assert counts[0] >= 0 >= counts[25], f'Invalid bars: {counts}'
+        self._counts = list(counts)
+        for piece_color, sign in ((color.WHITE, 1), (color.RED, -1)):
+            on_board = sum(c * sign for c in counts if c * sign > 0)
+            assert on_board <= 15, f'Too many {piece_color} pieces: {counts}'
+            self._off[piece_color] = 15 - on_board
+        self._hash = self._compute_hash()
+        self._count_pieces()
 
     def move(self, from_point, to_point):
         if not isinstance(from_point, int):
             from_point = from_point.number
         assert 0 <= from_point <= 25, f'Valid points are [0..25]: {from_point}'
-        from_point = self.points[from_point]
         if not isinstance(to_point, int):
             to_point = to_point.number
         assert 0 <= to_point <= 25, f'Valid points are [0..25]: {to_point}'
-        to_point = self.points[to_point]
-        bear_off = to_point in {
-            self.bear_off(color.WHITE),
-            self.bear_off(color.RED)
-        }
-        if not bear_off:
-            assert not to_point.blocked(from_point.color), \
-                'Cannot move to a blocked point'
-        different_colors = from_point.color != to_point.color
-        if to_point.pieces and different_colors and not bear_off:
-            self.bar(to_point.color).push(to_point.pop())
-        to_point.push(from_point.pop())
+        counts = self._counts
+        sign = (counts[from_point] > 0) - (counts[from_point] < 0)
+        assert sign, 'No pieces at this Point'
+        if to_point == 0 or to_point == 25:
+            self._add(from_point, -sign)
+            self._add_off(color.WHITE if sign > 0 else color.RED, 1)
+            return False
+        assert counts[to_point] * sign > -2, 'Cannot move to a blocked point'
+        self._add(from_point, -sign)
+        hit = counts[to_point] == -sign
+        if hit:
+            self._add(to_point, sign)
+            self._add(25 if sign > 0 else 0, -sign)
+        self._add(to_point, sign)
+        return hit
+
+    def unmake_move(self, from_point, to_point, hit=False):
+        """Take back `move(from_point, to_point)`, which returned `hit`."""
+        counts = self._counts
+        if to_point == 0 or to_point == 25:
+            piece_color = color.WHITE if to_point == 25 else color.RED
+            assert self._off[piece_color], 'No pieces are borne off'
+            self._add_off(piece_color, -1)
+            sign = 1 if piece_color == color.WHITE else -1
+        else:
+            sign = (counts[to_point] > 0) - (counts[to_point] < 0)
+            assert sign, 'No pieces at this Point'
+            self._add(to_point, -sign)
+            if hit:
+                self._add(25 if sign > 0 else 0, sign)
+                self._add(to_point, -sign)
+        self._add(from_point, sign)
 
     def possible_moves(self, roll, point):
-        if isinstance(point, int):
-            assert 0 <= point <= 25, f'Valid points are [0..25]: {point}'
-            point = self.points[point]
-        assert point.pieces, f'There are no pieces on this point: {point}'
-        direction = 1 if point.color == color.WHITE else -1
+        if not isinstance(point, int):
+            point = point.number
+        assert 0 <= point <= 25, f'Valid points are [0..25]: {point}'
+        counts = self._counts
+        assert counts[point], f'There are no pieces on this point: {point}'
+        sign = 1 if counts[point] > 0 else -1
+        piece_color = color.WHITE if sign > 0 else color.RED
         dies = roll.dies
         if not dies:
             return []
@@ -156,97 +208,248 @@ class Board:
             paths = [(dies[0],) * len(dies)]
         else:
             paths = [(dies[0], dies[1]), (dies[1], dies[0])]
-        many_in_bar = len(self.bar_pieces(point.color)) > 1
+        many_in_bar = counts[0 if sign > 0 else 25] * sign > 1
         moves = []
         min_point = 1
         max_point = 24
-        if self.can_bear_off(point.color):
-            if point.color == color.RED:
+        if self.can_bear_off(piece_color):
+            if sign < 0:
                 min_point -= 1
             else:
                 max_point += 1
         for path in paths:
             if many_in_bar:
                 path = path[:1]
-            number = point.number
+            number = point
             for die in path:
-                number += direction * die
+                number += sign * die
                 if (number < min_point or number > max_point or
-                        self.points[number].blocked(point.color)):
+                        0 < number < 25 and counts[number] * sign < -1):
                     break
                 if number not in moves:
                     moves.append(number)
         return sorted(moves)
 
+    def possible_turns(self, roll, piece_color):
+        """Return every legal turn as a tuple of single die moves.
+
+        Only turns using as many dies as possible are legal, and turns
+        leading to the same position are returned once.
+        """
+        dies = roll.dies
+        if len(dies) == 2 and dies[0] != dies[1]:
+            orders = (dies, dies[::-1])
+        else:
+            orders = (dies,)
+        turns = {}
+        for order in orders:
+            self._collect_turns(piece_color, order, [], turns, 0)
+        longest = max(len(moves) for moves in turns.values())
+        return [moves for moves in turns.values() if len(moves) == longest]
+
     def can_bear_off(self, piece_color):
-        points = range(19) if piece_color == color.WHITE else range(7, 26)
-        for point in points:
-            if piece_color == self.points[point].color:
-                return False
-        return True
+        return self._home[piece_color] + self._off[piece_color] == 15
+
+    def pip_count(self, piece_color):
+        return self._pips[piece_color]
+
+    def home_count(self, piece_color):
+        return self._home[piece_color]
+
+    def bar_count(self, piece_color):
+        if piece_color == color.WHITE:
+            return self._counts[0]
+        return -self._counts[25]
+
+    def off_count(self, piece_color):
+        return self._off[piece_color]
 
     @property
     def finished(self):
-        bear_off_whites = [p for p in self.bear_off(color.WHITE).pieces if
-                           p.color == color.WHITE]
-        bear_off_reds = [p for p in self.bear_off(color.RED).pieces if
-                         p.color == color.RED]
-        return len(bear_off_whites) == 15 or len(bear_off_reds) == 15
+        return self._off[color.WHITE] == 15 or self._off[color.RED] == 15
+
+    def blocked(self, number, piece_color):
+        count = self._counts[number]
+        if piece_color == color.WHITE:
+            count = -count
+        return 0 < number < 25 and count > 1
+
+    def color_count(self, number, piece_color):
+        if number == 0:
+            if piece_color == color.WHITE:
+                return self._counts[0]
+            return self._off[color.RED]
+        if number == 25:
+            if piece_color == color.RED:
+                return -self._counts[25]
+            return self._off[color.WHITE]
+        count = self._counts[number]
+        if piece_color == color.RED:
+            count = -count
+        return max(count, 0)
+
+    def point_color(self, number):
+        if number == 0:
+            if self._counts[0]:
+                return color.WHITE
+            return color.RED if self._off[color.RED] else None
+        if number == 25:
+            if self._counts[25]:
+                return color.RED
+            return color.WHITE if self._off[color.WHITE] else None
+        count = self._counts[number]
+        if count:
+            return color.WHITE if count > 0 else color.RED
+        return None
+
+    def point_pieces(self, number):
+        return (self._color_pieces(number, color.WHITE) +
+                self._color_pieces(number, color.RED))
 
     def bar(self, piece_color):
         return self.points[0 if piece_color == color.WHITE else 25]
 
     def bar_pieces(self, piece_color):
-        return tuple(
-            p for p in self.bar(piece_color).pieces if
-            p.color == piece_color
-        )
+        number = 0 if piece_color == color.WHITE else 25
+        return self._color_pieces(number, piece_color)
 
     def bear_off(self, piece_color):
         return self.points[0 if piece_color == color.RED else 25]
 
     def bear_off_pieces(self, piece_color):
-        return tuple(
-            p for p in self.bear_off(piece_color).pieces if
-            p.color == piece_color
-        )
+        number = 0 if piece_color == color.RED else 25
+        return self._color_pieces(number, piece_color)
 
     def strongholds(self, piece_color):
-        return [p for p in self.points if p.color == piece_color and len(p.pieces) > 1]
+        return [self.points[i] for i in range(26) if
+                self.point_color(i) == piece_color and
+                self._point_size(i) > 1]
 
     def saved_pieces(self, piece_color):
         if piece_color == color.WHITE:
-            enemy = color.RED
-            behind = operator.gt
             last_point = max(i for i in range(25, 1, -1)
-                             if self.points[i].color == enemy)
-            enemy_line = self.points[last_point]
+                             if self.point_color(i) == color.RED)
+            numbers = range(last_point + 1, 26)
         else:
-            enemy = color.WHITE
-            behind = operator.lt
-            last_point = max(i for i in range(24) if self.points[i].color == enemy)
-            enemy_line = self.points[last_point]
-        return [p for p in self.points if behind(p, enemy_line) and p.pieces]
+            last_point = max(i for i in range(24)
+                             if self.point_color(i) == color.WHITE)
+            numbers = range(last_point)
+        return [self.points[i] for i in numbers if self._point_size(i)]
 
     def exposed_pieces(self, piece_color):
         saved = self.saved_pieces(piece_color)
-        bar = self.bar(piece_color)
-        return [p for p in self.points if
-                p.color == piece_color and
-                len(p.pieces) == 1 and
-                p not in saved and
-                p != bar]
+        bar = 0 if piece_color == color.WHITE else 25
+        return [self.points[i] for i in range(26) if
+                self.point_color(i) == piece_color and
+                self._point_size(i) == 1 and
+                self.points[i] not in saved and
+                i != bar]
+
+    def _color_pieces(self, number, piece_color):
+        count = self.color_count(number, piece_color)
+        if not count:
+            return ()
+        first = sum(self.color_count(i, piece_color) for i in range(number))
+        return PIECES[piece_color][first:first + count]
+
+    def _collect_turns(self, piece_color, dies, moves, turns, first_from):
+        die_moves = self._die_moves(piece_color, dies[0]) if dies else []
+        if not die_moves:
+            turns.setdefault(self._position(), tuple(moves))
+            return
+        sign = 1 if piece_color == color.WHITE else -1
+        doubles = len(dies) > 1 and dies[0] == dies[1]
+        for from_point, to_point in die_moves:
+            # Equal dies may be played in any order, so only sequences
+            # going from back to front are tried.
+            progress = from_point if sign > 0 else 25 - from_point
+            if doubles and progress < first_from:
+                continue
+            hit = self.move(from_point, to_point)
+            moves.append((from_point, to_point))
+            self._collect_turns(piece_color, dies[1:], moves, turns, progress)
+            moves.pop()
+            self.unmake_move(from_point, to_point, hit)
+
+    def _die_moves(self, piece_color, die):
+        counts = self._counts
+        if piece_color == color.WHITE:
+            sign, bar, home = 1, 0, 25
+        else:
+            sign, bar, home = -1, 25, 0
+        if counts[bar]:
+            sources = (bar,)
+        else:
+            sources = [i for i in range(1, 25) if counts[i] * sign > 0]
+        bear_off = self.can_bear_off(piece_color)
+        moves = []
+        for from_point in sources:
+            to_point = from_point + sign * die
+            if 0 < to_point < 25:
+                if counts[to_point] * sign > -2:
+                    moves.append((from_point, to_point))
+            elif to_point == home and bear_off:
+                moves.append((from_point, to_point))
+        return moves
+
+    def _add(self, number, delta):
+        count = self._counts[number]
+        new_count = count + delta
+        keys = ZOBRIST_POINTS[number]
+        self._hash ^= keys[count + 15] ^ keys[new_count + 15]
+        self._counts[number] = new_count
+        # A counter never changes its sign in one step, so the color of
+        # the changed pieces is the sign of either count.
+        change = abs(new_count) - abs(count)
+        if count > 0 or new_count > 0:
+            self._pips[color.WHITE] += change * (25 - number)
+            if number >= 19:
+                self._home[color.WHITE] += change
+        else:
+            self._pips[color.RED] += change * number
+            if number <= 6:
+                self._home[color.RED] += change
+
+    def _add_off(self, piece_color, delta):
+        off = self._off[piece_color]
+        keys = ZOBRIST_OFF[piece_color]
+        self._hash ^= keys[off] ^ keys[off + delta]
+        self._off[piece_color] = off + delta
+
+    def _compute_hash(self):
+        hash_ = 0
+        for number, count in enumerate(self._counts):
+            hash_ ^= ZOBRIST_POINTS[number][count + 15]
+        for piece_color, off in self._off.items():
+            hash_ ^= ZOBRIST_OFF[piece_color][off]
+        return hash_
+
+    def _count_pieces(self):
+        counts = self._counts
+        self._pips = {
+            color.WHITE: sum((25 - i) * c for i, c in enumerate(counts) if c > 0),
+            color.RED: sum(i * -c for i, c in enumerate(counts) if c < 0)
+        }
+        self._home = {
+            color.WHITE: sum(c for c in counts[19:25] if c > 0),
+            color.RED: sum(-c for c in counts[1:7] if c < 0)
+        }
+
+    def _position(self):
+        return (*self._counts, self._off[color.WHITE], self._off[color.RED])
+
+    def _point_size(self, number):
+        return (self.color_count(number, color.WHITE) +
+                self.color_count(number, color.RED))
 
     def _on_start(self, piece_color, start_state):
-        number = 1
+        sign = 1 if piece_color == color.WHITE else -1
         for point, count in start_state:
-            for i in range(count):
-                self.points[point].push(Piece(piece_color, number))
-                number += 1
+            self._counts[point] = sign * count
 
     def _clear_points(self):
-        for point in self.points:
-            point.clear()
+        self._counts = [0] * 26
+        self._off = {color.WHITE: 0, color.RED: 0}
 
 
 class Roll:
@@ -287,6 +490,9 @@ class Roll:
                 raise ValueError('Impossible move')
         self._dies = tuple(dies_to_use)
 
+    def restore(self, dies):
+        self._dies = dies
+
 
 class Turn:
     def __init__(self, roll, moves):
@@ -314,10 +520,17 @@ class Backgammon:
     def __init__(self):
         self.board = Board()
         self.history = []
+        self._undo = []
+        self._first_color = color.WHITE
 
-    def restart(self):
-        self.board.on_start()
+    def restart(self, counts=None, first_color=color.WHITE):
+        if counts is None:
+            self.board.on_start()
+        else:
+            self.board.set_counts(counts)
         self.history = []
+        self._undo = []
+        self._first_color = first_color
 
     @property
     def game_over(self):
@@ -329,7 +542,9 @@ class Backgammon:
 
     @property
     def color(self):
-        return color.RED if len(self.history) % 2 == 0 else color.WHITE
+        if len(self.history) % 2 == 1:
+            return self._first_color
+        return color.RED if self._first_color == color.WHITE else color.WHITE
 
     @property
     def moves(self):
@@ -338,7 +553,7 @@ class Backgammon:
     @property
     def possible_points(self):
         bar = self.board.bar(self.color)
-        if self.board.bar_pieces(self.color):
+        if self.board.bar_count(self.color):
             if self.board.possible_moves(self.roll, bar):
                 return [bar]
             else:
@@ -350,15 +565,64 @@ class Backgammon:
                 possible_points_.append(point)
         return possible_points_
 
+    @property
+    def possible_turns(self):
+        return self.board.possible_turns(self.roll, self.color)
+
+    def is_possible_move(self, from_point, to_point):
+        """Whether the move is one `possible_points` and the board allow."""
+        if not self.history or not 0 <= from_point <= 25:
+            return False
+        piece_color = self.color
+        bar = 0 if piece_color == color.WHITE else 25
+        if self.board.bar_count(piece_color):
+            if from_point != bar:
+                return False
+        elif not (0 < from_point < 25 and
+                  self.board.color_count(from_point, piece_color)):
+            return False
+        return to_point in self.board.possible_moves(self.roll, from_point)
+
+    @property
+    def can_move(self):
+        """Cheaper `bool(possible_points)`."""
+        piece_color = self.color
+        if self.board.bar_count(piece_color):
+            bar = 0 if piece_color == color.WHITE else 25
+            return bool(self.board.possible_moves(self.roll, bar))
+        return any(
+            self.board.color_count(number, piece_color) and
+            self.board.possible_moves(self.roll, number)
+            for number in range(1, 25)
+        )
+
     def move(self, from_point, to_point):
         if isinstance(from_point, Point):
             from_point = from_point.number
         if isinstance(to_point, Point):
             to_point = to_point.number
-        self.board.move(from_point, to_point)
+        unused_dies = self.roll.dies
+        hit = self.board.move(from_point, to_point)
         dies = abs(from_point - to_point)
         self.roll.use(dies)
         self.moves.append((from_point, to_point))
+        self._undo.append((unused_dies, hit))
+
+    def unmake_move(self):
+        """Take back the last move of the current turn.
+
+        A hit piece goes back from the bar and the used dies are
+        returned to the roll.
+        """
+        assert self.moves, 'No moves to take back in this turn'
+        from_point, to_point = self.moves.pop()
+        unused_dies, hit = self._undo.pop()
+        self.board.unmake_move(from_point, to_point, hit)
+        self.roll.restore(unused_dies)
 
     def roll_dice(self, roll=None):
         self.history.append(Turn(roll or Roll(), []))
+
+    def unroll_dice(self):
+        assert not self.moves, 'Take back the moves of the turn first'
+        self.history.pop()
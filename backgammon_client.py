@@ -33,8 +33,8 @@ class BackgammonGameClient:
             self.world.update()
             self.clock.tick(self.frame_rate)
 
-    def restart(self):
-        self.game.restart()
+    def restart(self, counts=None, first_color=color.WHITE):
+        self.game.restart(counts, first_color)
         self._points_on_start()
 
     def save_history(self, filename):
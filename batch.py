@@ -0,0 +1,70 @@
+"""Move generation for many boards at once with NumPy.
+
+Positions are rows of a 2-D integer array laid out as `Board.counts`:
+white pieces are positive, red pieces negative, the white bar is column
+0 and the red bar is column 25. Red boards are turned around, so that
+every side to move goes from 0 to 25, and the results are turned back.
+"""
+import numpy as np
+
+import color
+
+
+POINTS = np.arange(26)
+
+
+def counts(boards):
+    """Stack the counters of `Board` objects into a position array."""
+    return np.array([board.counts for board in boards], dtype=np.int8)
+
+
+def signs(colors):
+    """+1 for every white and -1 for every red side to move."""
+    return np.where(np.asarray(colors) == color.WHITE, 1, -1)
+
+
+def can_bear_off(positions, sides):
+    relative = _relative(np.asarray(positions), np.asarray(sides))
+    return (relative[:, :19] <= 0).all(axis=1)
+
+
+def possible_moves(positions, rolls, sides):
+    """Destinations of every single die move of every board.
+
+    `positions` has shape (n, 26), `rolls` (n, 2) holds both dies and
+    `sides` (n,) is +1 when white and -1 when red is to move. The result
+    has shape (n, 26, 2): the point reached from every point with every
+    die, or -1 when the move is illegal. The rules are those of
+    `Board.possible_moves`: pieces on the bar have to enter first, a
+    point with two or more enemy pieces is blocked, and a piece is borne
+    off by an exact die once all pieces are at home. Moves with more
+    dies are chains of these single die moves.
+    """
+    positions = np.asarray(positions)
+    rolls = np.asarray(rolls)
+    sides = np.asarray(sides)
+    relative = _relative(positions, sides)
+    rows = np.arange(len(relative))[:, None, None]
+    on_bar = relative[:, 0] > 0
+    sources = relative > 0
+    sources[on_bar, 1:] = False
+    bear_off = (relative[:, :19] <= 0).all(axis=1)
+    to_points = POINTS[None, :, None] + rolls[:, None, :]
+    targets = relative[rows, np.minimum(to_points, 25)]
+    legal = (((to_points <= 24) & (targets >= -1)) |
+             ((to_points == 25) & bear_off[:, None, None]))
+    legal &= sources[:, :, None]
+    destinations = np.where(legal, to_points, -1)
+    red = sides < 0
+    destinations[red] = np.where(
+        destinations[red] >= 0, 25 - destinations[red], -1
+    )[:, ::-1]
+    return destinations
+
+
+def _relative(positions, sides):
+    """Positions as seen by the side to move, with its bar at 0."""
+    relative = positions * sides[:, None]
+    red = sides < 0
+    relative[red] = relative[red][:, ::-1]
+    return relative
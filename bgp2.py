@@ -0,0 +1,228 @@
+"""Version 2 of BGP: length-prefixed binary frames.
+
+A frame is one byte of length followed by the body: one byte of message
+type and the arguments. TURN carries all moves of a turn in one frame
+and, from the server, the dies of the next turn, where version 1 needs
+up to four MOVEs, ENDMOVE and DIES.
+
+A client asks for version 2 by sending the version 1 message VERSION 2
+before it gets a color. The server answers VERSION 2 (or VERSION 1 if
+it keeps version 1) and both sides use that version from then on. Old
+servers close the connection instead.
+
+With the color a player gets a SESSION token. After losing the
+connection it may connect again and send RESUME with the token right
+after VERSION 2, without waiting for the reply; the server answers with
+a SNAPSHOT of the game: the position at the start of the turn, its dies
+and the moves made so far.
+
+Instead of playing, a client may WATCH a running game by its number,
+sent the same way. It gets a SNAPSHOT of the game for white, then the
+DIES, MOVEs, TURNs and ENDMOVEs of both players and finally QUIT.
+
+The server sends PING to quiet connections; clients answer PONG.
+"""
+import struct
+
+
+VERSION_MESSAGE = b'VERSION 2 '
+MESSAGE_SIZE = len(VERSION_MESSAGE)
+BUFFER_SIZE = 4096
+
+(COLOR, DIES, MOVE, ENDMOVE, QUIT, LOBBY, RATE, TURN,
+ SESSION, RESUME, SNAPSHOT, WATCH, PING, PONG) = range(1, 15)
+
+COMMANDS = {
+    COLOR: 'COLOR',
+    DIES: 'DIES',
+    MOVE: 'MOVE',
+    ENDMOVE: 'ENDMOVE',
+    QUIT: 'QUIT',
+    LOBBY: 'LOBBY',
+    RATE: 'RATE',
+    TURN: 'TURN',
+    SESSION: 'SESSION',
+    RESUME: 'RESUME',
+    SNAPSHOT: 'SNAPSHOT',
+    WATCH: 'WATCH',
+    PING: 'PING',
+    PONG: 'PONG'
+}
+
+_RATING = struct.Struct('>i')
+_GAME = struct.Struct('>I')
+_COUNTS = struct.Struct('26b')
+
+
+def frame(kind, payload=b''):
+    assert len(payload) < 255, f'Frame is too long: {len(payload)}'
+    return bytes((len(payload) + 1, kind)) + payload
+
+
+def color_frame(piece_color):
+    return frame(COLOR, piece_color.encode('ascii'))
+
+
+def dies_frame(die1, die2):
+    return frame(DIES, bytes((die1, die2)))
+
+
+def move_frame(from_point, to_point):
+    return frame(MOVE, bytes((from_point, to_point)))
+
+
+def end_move_frame():
+    return frame(ENDMOVE)
+
+
+def quit_frame():
+    return frame(QUIT)
+
+
+def ping_frame():
+    return frame(PING)
+
+
+def pong_frame():
+    return frame(PONG)
+
+
+def lobby_frame(lobby):
+    return frame(LOBBY, lobby.encode('utf-8'))
+
+
+def rating_frame(rating):
+    return frame(RATE, _RATING.pack(rating))
+
+
+def turn_frame(moves, dies=(0, 0)):
+    """All moves of a turn; the server adds the dies of the next turn."""
+    return frame(TURN, bytes(dies) + bytes(point for move in moves
+                                           for point in move))
+
+
+def session_frame(token):
+    return frame(SESSION, token)
+
+
+def resume_frame(token):
+    return frame(RESUME, token)
+
+
+def snapshot_frame(piece_color, turn_color, dies, counts, moves):
+    """Position of the player of `piece_color` where `turn_color` moves."""
+    return frame(SNAPSHOT, (piece_color + turn_color).encode('ascii') +
+                 bytes(dies) + _COUNTS.pack(*counts) +
+                 bytes(point for move in moves for point in move))
+
+
+def watch_frame(game):
+    return frame(WATCH, _GAME.pack(game))
+
+
+class Decoder:
+    """Splits the bytes received on a connection into messages.
+
+    Messages of version 1 have MESSAGE_SIZE bytes, frames of version 2
+    are prefixed by their length. Bytes are read in chunks of up to
+    BUFFER_SIZE into one buffer and a message split between two reads is
+    kept for the next one. The version may change between messages, as
+    it does after VERSION.
+    """
+    def __init__(self):
+        # A partial frame and a whole chunk always fit.
+        self._buffer = bytearray(BUFFER_SIZE + 256)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def decode(self, version):
+        """Return the next message, or None until more bytes arrive."""
+        size = self._size(version)
+        if size is None:
+            return None
+        start = self._start + (version == 2)
+        self._start = start + size
+        return bytes(self._view[start:self._start])
+
+    def has_message(self, version):
+        return self._size(version) is not None
+
+    def receive(self, sock):
+        """Read from the socket; the number of bytes, 0 once it is closed."""
+        self._compact()
+        count = sock.recv_into(self._view[self._end:])
+        self._end += count
+        return count
+
+    def feed(self, data):
+        self._compact()
+        end = self._end + len(data)
+        assert end <= len(self._buffer), f'Chunk is too long: {len(data)}'
+        self._view[self._end:end] = data
+        self._end = end
+
+    def pending(self):
+        """Bytes received but not decoded yet."""
+        return bytes(self._view[self._start:self._end])
+
+    def _size(self, version):
+        available = self._end - self._start
+        if version == 1:
+            size = MESSAGE_SIZE
+        elif available:
+            size = self._buffer[self._start]
+            available -= 1
+        else:
+            return None
+        return size if available >= size else None
+
+    def _compact(self):
+        if self._start:
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+
+def parse_frame(body):
+    """Message of a frame body, in the form of `bgp_client.parse_message`.
+
+    TURN has `moves` and, if there are dies, `args`. SNAPSHOT has the
+    player's color in `arg`, the color to move in `turn`, `args`,
+    `counts` and `moves`.
+    """
+    command = COMMANDS.get(body[0]) if body else None
+    if command is None:
+        raise ValueError(f'Invalid protocol frame: {bytes(body)}')
+    payload = body[1:]
+    message = {'command': command}
+    if command in {'DIES', 'MOVE'}:
+        if len(payload) != 2:
+            raise ValueError(f'Invalid {command} frame: {bytes(body)}')
+        message['args'] = (payload[0], payload[1])
+    elif command == 'COLOR':
+        message['arg'] = payload.decode('ascii')
+    elif command == 'LOBBY':
+        message['arg'] = payload.decode('utf-8')
+    elif command == 'RATE':
+        message['arg'] = _RATING.unpack(payload)[0]
+    elif command == 'WATCH':
+        message['arg'] = _GAME.unpack(payload)[0]
+    elif command == 'TURN':
+        if len(payload) < 2 or len(payload) % 2:
+            raise ValueError(f'Invalid TURN frame: {bytes(body)}')
+        if payload[0]:
+            message['args'] = (payload[0], payload[1])
+        message['moves'] = tuple(zip(payload[2::2], payload[3::2]))
+    elif command in {'SESSION', 'RESUME'}:
+        message['arg'] = bytes(payload)
+    elif command == 'SNAPSHOT':
+        size = 4 + _COUNTS.size
+        if len(payload) < size or (len(payload) - size) % 2:
+            raise ValueError(f'Invalid SNAPSHOT frame: {bytes(body)}')
+        message['arg'] = chr(payload[0])
+        message['turn'] = chr(payload[1])
+        message['args'] = (payload[2], payload[3])
+        message['counts'] = _COUNTS.unpack(bytes(payload[4:size]))
+        message['moves'] = tuple(zip(payload[size::2], payload[size + 1::2]))
+    return message
@@ -1,47 +1,309 @@
+import queue
 import socket
+import threading
+
+import bgp2
+import codec
+
+
+MESSAGE_SIZE = 10
+NEGOTIATION_TIMEOUT = 1.0
+
+
+def lobby_message(lobby):
+    return codec.message(f'LOBBY {lobby}')
+
+
+def rating_message(rating):
+    return codec.message(f'RATE {rating}')
+
+
+def version_message(version):
+    return codec.message(f'VERSION {version}')
+
+
+def dies_message(die1, die2):
+    return codec.DIES_MESSAGES[die1, die2]
+
+
+def move_message(from_point, to_point):
+    return codec.MOVE_MESSAGES[from_point, to_point]
+
+
+def end_move_message():
+    return codec.END_MOVE_MESSAGE
+
+
+def quit_message():
+    return codec.QUIT_MESSAGE
+
+
+def ping_message():
+    return codec.PING_MESSAGE
+
+
+def pong_message():
+    return codec.PONG_MESSAGE
+
+
+def parse_message(message):
+    parsed = codec.MESSAGES.get(message)
+    if parsed is not None:
+        return parsed
+    message = message.decode('utf-8')
+    formed_message = {'command': message[:(len(message.split()[0]))]}
+    if message.startswith('DIES') or message.startswith('MOVE'):
+        formed_message['args'] = tuple(int(i) for i in message[4:].split()[:2])
+    elif message.startswith('COLOR'):
+        formed_message['arg'] = message[5:].strip()
+    elif message.startswith('LOBBY'):
+        formed_message['arg'] = message[5:].strip()
+    elif message.startswith('RATE'):
+        formed_message['arg'] = int(message[4:])
+    elif message.startswith('VERSION'):
+        formed_message['arg'] = int(message[7:])
+    return formed_message
+
+
+def read_message(connection, decoder, version):
+    """Next message of the version from the socket, through the decoder."""
+    message = decoder.decode(version)
+    while message is None:
+        if not decoder.receive(connection):
+            raise ConnectionError('Connection is closed by the server')
+        message = decoder.decode(version)
+    return message
 
 
 class BGPClient:
-    def __init__(self, connection, timeout=0.001):
+    """Client of BGP version 2 or 1, asked for with VERSION on connecting.
+
+    In version 2 the moves of a turn are sent together by
+    `send_end_move`, or by `flush` when the last move has won the game.
+    A TURN received from the server is returned as its MOVEs, ENDMOVE
+    and DIES, one by one. The SESSION token is kept for `resume` and
+    PINGs of the server are answered at once, neither is returned.
+
+    Once connected, a thread reads the messages into a queue, so
+    `receive` only waits when `pending` is 0, for up to `timeout`
+    seconds.
+    """
+    def __init__(self, connection, timeout=0.001, version=2):
+        assert version in {1, 2}, f'Unknown BGP version: {version}'
         self.connection = connection
         self.timeout = timeout
+        self.version = version
+        self.protocol = 1
         self._socket = None
+        self._decoder = bgp2.Decoder()
+        self._messages = queue.SimpleQueue()
+        self._reader = None
+        self._moves = []
+        self.session = None
 
     @property
     def closed(self):
         return self._socket is None
 
+    @property
+    def pending(self):
+        """Number of messages (or a connection error) to receive."""
+        return self._messages.qsize()
+
     def connect(self):
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.settimeout(self.timeout)
-        self._socket.connect(self.connection)
+        """Connect or raise; a client that has failed to is closed."""
+        self.session = None
+        try:
+            self._connect()
+            if not self._negotiate(version_message(self.version)):
+                raise ConnectionError('Server has not answered VERSION')
+        except OSError:
+            if not self.closed:
+                self.close()
+            raise
+        self._start_reader()
 
     def close(self):
+        try:
+            # Wakes the reader up.
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._socket.close()
         self._socket = None
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+
+    def resume(self):
+        """Connect again and take back the seat of the session.
+
+        Return the SNAPSHOT of the game, or None if the game is over.
+        """
+        if self.session is None:
+            return None
+        if not self._connect_with(bgp2.resume_frame(self.session)):
+            return None
+        try:
+            message = self.receive(NEGOTIATION_TIMEOUT)
+        except OSError:
+            # Some servers close the connection of unknown sessions.
+            message = None
+        if message is None or message['command'] != 'SNAPSHOT':
+            self.close()
+            return None
+        return message
+
+    def watch(self, game):
+        """Connect to watch the game of the number instead of playing.
+
+        The game comes as its SNAPSHOT, its messages and QUIT. Return
+        False if the server does not speak version 2.
+        """
+        self.session = None
+        return self._connect_with(bgp2.watch_frame(game))
+
+    def receive(self, timeout=None):
+        """Next message; socket.timeout if none comes within `timeout`."""
+        while True:
+            message = self._receive(
+                self.timeout if timeout is None else timeout
+            )
+            if message['command'] != 'PING':
+                return message
+            if self.protocol == 2:
+                self._socket.sendall(codec.PONG_FRAME)
+            else:
+                self._socket.send(pong_message())
 
-    def receive(self):
-        message = self._socket.recv(10)
-        message = message.decode('utf-8')
-        formed_message = {'command': message[:(len(message.split()[0]))]}
-        if message.startswith('DIES') or message.startswith('MOVE'):
-            formed_message['args'] = tuple(int(i) for i in message[4:].split()[:2])
-        elif message.startswith('COLOR'):
-            formed_message['arg'] = message[5:].strip()
-        return formed_message
+    def send_lobby(self, lobby):
+        if self.protocol == 2:
+            self._socket.sendall(bgp2.lobby_frame(lobby))
+        else:
+            self._socket.send(lobby_message(lobby))
+
+    def send_rating(self, rating):
+        if self.protocol == 2:
+            self._socket.sendall(bgp2.rating_frame(rating))
+        else:
+            self._socket.send(rating_message(rating))
 
     def send_dies(self, die1, die2):
-        message = f'DIES {die1} {die2}'.ljust(10, ' ')
-        self._socket.send(message.encode('utf-8'))
+        if self.protocol == 2:
+            self._socket.sendall(codec.DIES_FRAMES[die1, die2])
+        else:
+            self._socket.send(dies_message(die1, die2))
 
     def send_move(self, from_point, to_point):
-        message = f'MOVE {from_point} {to_point}'.ljust(10, ' ')
-        self._socket.send(message.encode('utf-8'))
+        if self.protocol == 2:
+            self._moves.append((from_point, to_point))
+        else:
+            self._socket.send(move_message(from_point, to_point))
 
     def send_end_move(self):
-        message = 'ENDMOVE'.ljust(10, ' ')
-        self._socket.send(message.encode('utf-8'))
+        if self.protocol == 2:
+            self.flush()
+        else:
+            self._socket.send(end_move_message())
 
     def send_quit(self):
-        message = 'QUIT'.ljust(10, ' ')
-        self._socket.send(message.encode('utf-8'))
+        if self.protocol == 2:
+            self._socket.sendall(codec.QUIT_FRAME)
+        else:
+            self._socket.send(quit_message())
+
+    def flush(self):
+        """Send the moves of the turn so far as the whole turn."""
+        if self.protocol == 2:
+            self._socket.sendall(bgp2.turn_frame(self._moves))
+            self._moves = []
+
+    def _receive(self, timeout):
+        try:
+            message = self._messages.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('No message from the server') from None
+        if isinstance(message, Exception):
+            # The connection stays broken for later calls.
+            self._messages.put(message)
+            raise message
+        return message
+
+    def _read_forever(self, connection, decoder, protocol, messages):
+        """Queue the messages of the connection, then what has ended it."""
+        try:
+            while True:
+                message = read_message(connection, decoder, protocol)
+                if protocol == 1:
+                    messages.put(parse_message(message))
+                else:
+                    self._expand(codec.parse_frame(message), messages)
+        except Exception as e:
+            messages.put(e)
+
+    def _start_reader(self):
+        # The reader keeps to this connection even if it is abandoned.
+        self._socket.settimeout(None)
+        self._reader = threading.Thread(
+            target=self._read_forever, name='BGPClient', daemon=True,
+            args=(self._socket, self._decoder, self.protocol, self._messages)
+        )
+        self._reader.start()
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.settimeout(NEGOTIATION_TIMEOUT)
+        self._socket.connect(self.connection)
+        self.protocol = 1
+        self._decoder = bgp2.Decoder()
+        self._messages = queue.SimpleQueue()
+        self._moves = []
+
+    def _connect_with(self, request):
+        """Connect with version 2, sending the request along with VERSION.
+
+        Sent at once, the request reaches the server before it may pair
+        the connection with a waiting player. False if it has not been
+        taken with version 2; the client is closed then.
+        """
+        if not self.closed:
+            self.close()
+        try:
+            self._connect()
+            if (self._negotiate(bgp2.VERSION_MESSAGE + request) and
+                    self.protocol == 2):
+                self._start_reader()
+                return True
+        except OSError:
+            pass
+        if not self.closed:
+            self.close()
+        return False
+
+    def _negotiate(self, data):
+        """Send VERSION; False unless the server answers it."""
+        try:
+            self._socket.sendall(data)
+            reply = read_message(self._socket, self._decoder, 1)
+        except ConnectionError:
+            return False
+        message = parse_message(reply)
+        # Old servers close the connection or send COLOR at once, new
+        # ones send QUIT when VERSION has come too late.
+        if message['command'] != 'VERSION':
+            return False
+        self.protocol = message['arg']
+        return True
+
+    def _expand(self, message, messages):
+        if message['command'] == 'SESSION':
+            self.session = message['arg']
+            return
+        if message['command'] != 'TURN':
+            messages.put(message)
+            return
+        for move in message['moves']:
+            messages.put({'command': 'MOVE', 'args': move})
+        if 'args' in message:
+            messages.put({'command': 'ENDMOVE'})
+            messages.put({'command': 'DIES', 'args': message['args']})
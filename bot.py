@@ -0,0 +1,145 @@
+"""A computer player choosing turns by expectiminimax search.
+
+At depth 1 the bot plays the turn with the best static evaluation. At
+depth 2 it also averages, over the 21 different rolls, the opponent's
+best reply to every candidate. Only the best candidates of depth 1 are
+searched deeper, best first, and the search stops at the time budget
+with the best turn found so far. Chance nodes are cached by position.
+"""
+import time
+
+import color
+from backgammon import Roll
+from transposition import TranspositionTable
+
+
+ROLLS = tuple(
+    (Roll(die1, die2), (1 if die1 == die2 else 2) / 36)
+    for die1 in range(1, 7) for die2 in range(die1, 7)
+)
+
+WIN = 100.0
+PIP_WEIGHT = 0.1
+POINT_WEIGHT = 0.5
+BLOT_WEIGHT = 0.6
+BAR_WEIGHT = 1.5
+OFF_WEIGHT = 0.2
+
+# The side to move is part of a chance node key.
+_RED_KEY = 0x9e3779b97f4a7c15
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def opponent_of(piece_color):
+    return color.RED if piece_color == color.WHITE else color.WHITE
+
+
+def evaluate(board, piece_color):
+    """Static value of the position for `piece_color`, bigger is better."""
+    opponent = opponent_of(piece_color)
+    if board.off_count(piece_color) == 15:
+        return WIN
+    if board.off_count(opponent) == 15:
+        return -WIN
+    sign = 1 if piece_color == color.WHITE else -1
+    points = blots = 0
+    for count in board.counts[1:25]:
+        count *= sign
+        if count > 1:
+            points += 1
+        elif count < -1:
+            points -= 1
+        elif count == 1:
+            blots += 1
+        elif count == -1:
+            blots -= 1
+    return (PIP_WEIGHT * (board.pip_count(opponent) -
+                          board.pip_count(piece_color)) +
+            POINT_WEIGHT * points -
+            BLOT_WEIGHT * blots +
+            BAR_WEIGHT * (board.bar_count(opponent) -
+                          board.bar_count(piece_color)) +
+            OFF_WEIGHT * (board.off_count(piece_color) -
+                          board.off_count(opponent)))
+
+
+class Bot:
+    """Policy choosing the turn with the best expectiminimax value.
+
+    The signature matches the policies of `simulate`, the seed is not
+    used because the search is deterministic.
+    """
+    def __init__(self, seed=None, depth=1, time_budget=None, width=8,
+                 table=None):
+        assert depth in {1, 2}, f'Search depth must be 1 or 2: {depth}'
+        self.depth = depth
+        self.time_budget = time_budget
+        self.width = width
+        self.table = table if table is not None else TranspositionTable()
+        self._deadline = None
+
+    def __call__(self, game, turns):
+        return self.choose(game.board, game.color, turns)
+
+    def choose(self, board, piece_color, turns):
+        if len(turns) == 1:
+            return turns[0]
+        if self.time_budget is not None:
+            self._deadline = time.perf_counter() + self.time_budget
+        else:
+            self._deadline = None
+        scored = sorted(
+            ((self._turn_value(board, piece_color, turn, 1), turn)
+             for turn in turns),
+            key=lambda item: item[0], reverse=True
+        )
+        best_value, best_turn = scored[0]
+        if self.depth == 1:
+            return best_turn
+        best_value = None
+        for _, turn in scored[:self.width]:
+            try:
+                value = self._turn_value(board, piece_color, turn, 2)
+            except SearchTimeout:
+                break
+            if best_value is None or value > best_value:
+                best_value, best_turn = value, turn
+        return best_turn
+
+    def _turn_value(self, board, piece_color, turn, depth):
+        hits = []
+        try:
+            for from_point, to_point in turn:
+                hits.append(board.move(from_point, to_point))
+            if depth == 1 or board.finished:
+                return evaluate(board, piece_color)
+            return -self._chance_value(board, opponent_of(piece_color),
+                                       depth - 1)
+        finally:
+            for (from_point, to_point), hit in zip(reversed(turn),
+                                                   reversed(hits)):
+                board.unmake_move(from_point, to_point, hit)
+
+    def _chance_value(self, board, piece_color, depth):
+        """Value for `piece_color` to roll in the position."""
+        key = board.position_hash
+        if piece_color == color.RED:
+            key ^= _RED_KEY
+        value = self.table.get(key, depth)
+        if value is not None:
+            return value
+        value = 0.0
+        for roll, probability in ROLLS:
+            if (self._deadline is not None and
+                    time.perf_counter() > self._deadline):
+                raise SearchTimeout()
+            turns = board.possible_turns(roll, piece_color)
+            value += probability * max(
+                self._turn_value(board, piece_color, turn, depth)
+                for turn in turns
+            )
+        self.table.store(key, value, depth)
+        return value
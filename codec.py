@@ -0,0 +1,67 @@
+"""Encoded BGP messages of a game, built once.
+
+A game has few different messages: 36 DIES, 26 x 26 MOVEs, two COLORs
+and some without arguments. They are encoded here in both versions of
+BGP, and received ones are parsed by looking up their bytes in MESSAGES
+(version 1) or FRAMES (version 2 frame bodies). Messages with other
+arguments are built and parsed as usual. Looked up messages are shared,
+so they must not be changed.
+"""
+import bgp2
+from color import RED, WHITE
+
+
+DICE = range(1, 7)
+POINTS = range(26)
+
+MESSAGES = {}
+FRAMES = {}
+
+
+def message(text):
+    """The version 1 message of the text."""
+    return text.ljust(bgp2.MESSAGE_SIZE, ' ').encode('utf-8')
+
+
+def parse_frame(body):
+    """Like `bgp2.parse_frame`, looking the body up first."""
+    return FRAMES.get(body) or bgp2.parse_frame(body)
+
+
+def _add(parsed, encoded, frame):
+    MESSAGES[encoded] = parsed
+    FRAMES[frame[1:]] = parsed
+    return encoded, frame
+
+
+COLOR_MESSAGES, COLOR_FRAMES = {}, {}
+for _color in (WHITE, RED):
+    (COLOR_MESSAGES[_color],
+     COLOR_FRAMES[_color]) = _add({'command': 'COLOR', 'arg': _color},
+                                  message(f'COLOR {_color}'),
+                                  bgp2.color_frame(_color))
+
+DIES_MESSAGES, DIES_FRAMES = {}, {}
+for _dies in ((die1, die2) for die1 in DICE for die2 in DICE):
+    (DIES_MESSAGES[_dies],
+     DIES_FRAMES[_dies]) = _add({'command': 'DIES', 'args': _dies},
+                                message('DIES {} {}'.format(*_dies)),
+                                bgp2.dies_frame(*_dies))
+
+MOVE_MESSAGES, MOVE_FRAMES = {}, {}
+for _move in ((from_point, to_point)
+              for from_point in POINTS for to_point in POINTS):
+    (MOVE_MESSAGES[_move],
+     MOVE_FRAMES[_move]) = _add({'command': 'MOVE', 'args': _move},
+                                message('MOVE {} {}'.format(*_move)),
+                                bgp2.move_frame(*_move))
+
+END_MOVE_MESSAGE, END_MOVE_FRAME = _add({'command': 'ENDMOVE'},
+                                        message('ENDMOVE'),
+                                        bgp2.end_move_frame())
+QUIT_MESSAGE, QUIT_FRAME = _add({'command': 'QUIT'}, message('QUIT'),
+                                bgp2.quit_frame())
+PING_MESSAGE, PING_FRAME = _add({'command': 'PING'}, message('PING'),
+                                bgp2.ping_frame())
+PONG_MESSAGE, PONG_FRAME = _add({'command': 'PONG'}, message('PONG'),
+                                bgp2.pong_frame())
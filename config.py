@@ -69,5 +69,8 @@ MENU_BUTTON_IMAGES = {
     }
 }
 
+BOT_DEPTH = 2
+BOT_TIME_BUDGET = 1.0
+
 HOST = '192.168.0.100'
 PORT = 34299
@@ -0,0 +1,52 @@
+"""Dice sources for self-play and rollouts.
+
+Plain random dice give the same results as `Roll()`. Two variance
+reduction methods can be switched on for a numbered trial:
+
+* stratified first rolls: trial n starts with the (n mod 36)-th of the
+  36 equally likely rolls, so every 36 trials see all 21 different rolls
+  with their right weights;
+* antithetic trials: trials 2k and 2k + 1 share one random stream and
+  the second one gets every die turned upside down (7 - die).
+
+Both keep the estimates unbiased. The trials are not independent any
+more, so the usual confidence intervals become conservative.
+"""
+import random
+
+from backgammon import Roll
+
+
+FIRST_ROLLS = tuple((die1, die2) for die1 in range(1, 7)
+                    for die2 in range(1, 7))
+
+
+class RandomDice:
+    def __init__(self, seed=None, first_roll=None, mirror=False):
+        self._random = random.Random(seed)
+        self._first_roll = first_roll
+        self._mirror = mirror
+
+    def __call__(self):
+        if self._first_roll is not None:
+            die1, die2 = self._first_roll
+            self._first_roll = None
+        else:
+            die1 = self._random.randint(1, 6)
+            die2 = self._random.randint(1, 6)
+        if self._mirror:
+            die1, die2 = 7 - die1, 7 - die2
+        return Roll(die1, die2)
+
+
+def trial_stream(trial, antithetic=False):
+    """Number of the random stream used by the trial."""
+    return trial // 2 if antithetic else trial
+
+
+def trial_dice(seed, trial, stratify=False, antithetic=False):
+    """Dice of the trial, `seed` must be the same for antithetic pairs."""
+    stream = trial_stream(trial, antithetic)
+    first_roll = FIRST_ROLLS[stream % 36] if stratify else None
+    mirror = antithetic and trial % 2 == 1
+    return RandomDice(seed, first_roll, mirror)
@@ -0,0 +1,254 @@
+"""Load test of a BGP server with simulated players.
+
+Opens many concurrent connections to the server, every one a player
+keeping its own game and playing random legal turns to the end of the
+game, and reports the connection setup rate, the pairing latency, the
+round trip from the end of a turn to the next DIES and games/sec. The
+players speak version 1 of BGP or, with --version 2, send whole turns in
+one frame. Choosing turns takes CPU time, so heavy loads are generated
+by several processes:
+
+    python loadtest.py localhost:34299 --games 2000 --processes 4
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import bgp2
+import codec
+from backgammon import Backgammon, Roll
+from bgp_client import (MESSAGE_SIZE, end_move_message, move_message,
+                        parse_message, pong_message, quit_message,
+                        version_message)
+from simulate import RandomPolicy
+
+
+PERCENTILES = (50, 90, 99)
+
+
+class Stats:
+    def __init__(self):
+        self.connects = []
+        self.pairings = []
+        self.round_trips = []
+        self.games = 0
+        self.unfinished = 0
+        self.messages = 0
+        self.errors = Counter()
+        self.first_connect = None
+        self.last_connect = None
+        self.elapsed = 0.0
+
+    def __str__(self):
+        elapsed = self.elapsed or float('inf')
+        connecting = (self.last_connect or 0) - (self.first_connect or 0)
+        rate = len(self.connects) / connecting if connecting else 0.0
+        lines = [
+            f'connections: {len(self.connects)} ({rate:.1f}/s)',
+            f'games: {self.games} finished, {self.unfinished} cut short '
+            f'in {self.elapsed:.3f} s ({self.games / elapsed:.1f} games/s)',
+            f'messages: {self.messages} '
+            f'({self.messages / elapsed:.1f} messages/s)',
+            _latencies('connect', self.connects),
+            _latencies('pairing', self.pairings),
+            _latencies('round trip', self.round_trips),
+        ]
+        for error, count in self.errors.most_common():
+            lines.append(f'error: {error} x {count}')
+        return '\n'.join(lines)
+
+    def update(self, other):
+        self.connects += other.connects
+        self.pairings += other.pairings
+        self.round_trips += other.round_trips
+        self.games += other.games
+        self.unfinished += other.unfinished
+        self.messages += other.messages
+        self.errors.update(other.errors)
+        # perf_counter is the same clock in every process.
+        self.first_connect = min(filter(None, (self.first_connect,
+                                               other.first_connect)),
+                                 default=None)
+        self.last_connect = max(filter(None, (self.last_connect,
+                                              other.last_connect)),
+                                default=None)
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+
+def _latencies(name, values):
+    if not values:
+        return f'{name:>12}: -'
+    values = sorted(values)
+    last = len(values) - 1
+    percentiles = ', '.join(
+        f'p{p} {1000 * values[min(last, len(values) * p // 100)]:.2f}'
+        for p in PERCENTILES
+    )
+    return f'{name:>12}: {percentiles}, max {1000 * values[-1]:.2f} ms'
+
+
+async def play(address, stats, policy, max_turns, timeout, version=1):
+    """Connect, wait for an opponent and play one game to the end."""
+    clock = time.perf_counter
+    start = clock()
+    reader, writer = await asyncio.open_connection(*address)
+    connected = clock()
+    stats.connects.append(connected - start)
+    stats.first_connect = min(stats.first_connect or start, start)
+    stats.last_connect = max(stats.last_connect or connected, connected)
+
+    async def read(frames):
+        if frames:
+            size = await reader.readexactly(1)
+            return codec.parse_frame(await reader.readexactly(size[0]))
+        return parse_message(await reader.readexactly(MESSAGE_SIZE))
+
+    async def receive(frames=version == 2):
+        while True:
+            message = await asyncio.wait_for(read(frames), timeout)
+            stats.messages += 1
+            if message['command'] != 'PING':
+                return message
+            writer.write(pong_message() if version == 1
+                         else codec.PONG_FRAME)
+
+    try:
+        writer.write(version_message(version))
+        message = await receive(frames=False)
+        assert message == {'command': 'VERSION', 'arg': version}, \
+            f'No version {version}: {message}'
+        message = await receive()
+        assert message['command'] == 'COLOR', f'No color: {message}'
+        stats.pairings.append(clock() - connected)
+        piece_color = message['arg']
+        game = Backgammon()
+        turns = 0
+        ended = None
+        while True:
+            message = await receive()
+            command = message['command']
+            if command == 'QUIT':
+                return
+            if command == 'MOVE':
+                game.move(*message['args'])
+            elif command == 'TURN':
+                for from_point, to_point in message['moves']:
+                    game.move(from_point, to_point)
+            if command not in {'DIES', 'TURN'} or 'args' not in message:
+                continue
+            if ended is not None:
+                stats.round_trips.append(clock() - ended)
+                ended = None
+            game.roll_dice(Roll(*message['args']))
+            if game.color != piece_color:
+                continue
+            turn = policy(game, game.possible_turns)
+            for from_point, to_point in turn:
+                game.move(from_point, to_point)
+                if version == 1:
+                    writer.write(move_message(from_point, to_point))
+            turns += 1
+            if game.game_over or turns == max_turns:
+                if game.game_over:
+                    stats.games += 1
+                    if version == 2:
+                        writer.write(bgp2.turn_frame(turn))
+                else:
+                    stats.unfinished += 1
+                writer.write(quit_message() if version == 1
+                             else codec.QUIT_FRAME)
+                await writer.drain()
+                return
+            if version == 2:
+                writer.write(bgp2.turn_frame(turn))
+            else:
+                writer.write(end_move_message())
+            ended = clock()
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def load(address, players, connect_rate, concurrency, seed, max_turns,
+               timeout, version=1):
+    stats = Stats()
+    seeds = random.Random(seed)
+    running = asyncio.Semaphore(concurrency)
+
+    async def player():
+        try:
+            await play(address, stats, RandomPolicy(seeds.getrandbits(32)),
+                       max_turns, timeout, version)
+        except Exception as e:
+            stats.errors[type(e).__name__] += 1
+        finally:
+            running.release()
+
+    start = time.perf_counter()
+    tasks = []
+    for number in range(players):
+        await running.acquire()
+        if connect_rate:
+            delay = start + number / connect_rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(player()))
+    await asyncio.gather(*tasks)
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def run_load(*args):
+    return asyncio.run(load(*args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('address', help='host:port of the server')
+    parser.add_argument('--games', type=int, default=100,
+                        help='games to play, two connections each')
+    parser.add_argument('--connect-rate', type=float, default=0,
+                        help='new connections per second, 0 is unlimited')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='most connections open at once, '
+                             'all of them by default')
+    parser.add_argument('--max-turns', type=int, default=None,
+                        help='quit a game after this many turns per player')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds to wait for any message')
+    parser.add_argument('--version', type=int, choices=(1, 2), default=1,
+                        help='version of BGP the players speak')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes to share the players')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    host, port = args.address.split(':')
+    players = 2 * args.games
+    concurrency = args.concurrency or players
+    assert concurrency >= 2, f'Players need opponents: {concurrency}'
+    processes = args.processes
+    assert processes >= 1, f'Need at least one process: {processes}'
+    seeds = random.Random(args.seed)
+    shares = [players * number // processes
+              for number in range(processes + 1)]
+    jobs = [((host, int(port)), shares[number + 1] - shares[number],
+             args.connect_rate / processes,
+             max(concurrency // processes, 1),
+             seeds.getrandbits(32), args.max_turns, args.timeout,
+             args.version)
+            for number in range(processes)]
+    if processes == 1:
+        print(run_load(*jobs[0]))
+        return
+    stats = Stats()
+    with ProcessPoolExecutor(processes) as executor:
+        for result in executor.map(run_load, *zip(*jobs)):
+            stats.update(result)
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
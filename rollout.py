@@ -0,0 +1,209 @@
+"""Monte Carlo rollouts of a position on all CPU cores.
+
+Every trial plays the position to the end with its own dice and policy
+seeds, derived from the rollout seed and the trial number, so a rollout
+gives the same result with any number of workers:
+
+    python rollout.py --trials 10000 --seed 1 --max-error 0.01
+"""
+import argparse
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import color
+from backgammon import Backgammon, Board
+from dice import trial_dice, trial_stream
+from simulate import POLICIES, play_game
+
+
+class RolloutResult:
+    """Outcomes of the trials for the side to move.
+
+    Probabilities of gammons and backgammons include the bigger wins, so
+    `gammon` is the chance to win at least a gammon.
+    """
+    def __init__(self):
+        self.trials = 0
+        self.outcomes = dict.fromkeys((-3, -2, -1, 1, 2, 3), 0)
+
+    def __repr__(self):
+        return (f'RolloutResult(trials={self.trials}, '
+                f'win={self.win:.4f}, gammon={self.gammon:.4f}, '
+                f'backgammon={self.backgammon:.4f}, '
+                f'equity={self.equity:.4f})')
+
+    def add(self, outcomes):
+        for outcome in outcomes:
+            self.outcomes[outcome] += 1
+        self.trials += len(outcomes)
+
+    @property
+    def win(self):
+        return self._probability(1)
+
+    @property
+    def gammon(self):
+        return self._probability(2)
+
+    @property
+    def backgammon(self):
+        return self._probability(3)
+
+    @property
+    def lose_gammon(self):
+        return self._probability(-2)
+
+    @property
+    def lose_backgammon(self):
+        return self._probability(-3)
+
+    @property
+    def equity(self):
+        if not self.trials:
+            return 0.0
+        points = sum(o * n for o, n in self.outcomes.items())
+        return points / self.trials
+
+    def confidence(self, z=1.96):
+        """Half-widths of the Wilson intervals of the probabilities."""
+        n = max(self.trials, 1)
+        intervals = {}
+        for name in ('win', 'gammon', 'backgammon',
+                     'lose_gammon', 'lose_backgammon'):
+            p = getattr(self, name)
+            spread = math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+            intervals[name] = z * spread / (1 + z * z / n)
+        return intervals
+
+    def equity_error(self, z=1.96):
+        if self.trials < 2:
+            return math.inf
+        mean = self.equity
+        variance = sum(n * (o - mean) ** 2 for o, n in
+                       self.outcomes.items()) / (self.trials - 1)
+        return z * math.sqrt(variance / self.trials)
+
+    def _probability(self, outcome):
+        if not self.trials:
+            return 0.0
+        if outcome > 0:
+            wins = sum(n for o, n in self.outcomes.items() if o >= outcome)
+        else:
+            wins = sum(n for o, n in self.outcomes.items() if o <= outcome)
+        return wins / self.trials
+
+
+def trial_seed(seed, trial):
+    return f'{seed}:{trial}'
+
+
+def play_trials(counts, piece_color, seed, trials, policy='random',
+                stratify=False, antithetic=False):
+    """Play the given trial numbers, return their outcomes."""
+    game = Backgammon()
+    outcomes = []
+    for trial in trials:
+        stream = trial_stream(trial, antithetic)
+        seeds = random.Random(trial_seed(seed, stream))
+        white = POLICIES[policy](seeds.getrandbits(32))
+        red = POLICIES[policy](seeds.getrandbits(32))
+        dice = trial_dice(seeds.getrandbits(32), trial, stratify, antithetic)
+        game.restart(counts, piece_color)
+        winner = play_game(white, red, dice, game=game)
+        outcome = game_value(game.board, winner)
+        outcomes.append(outcome if winner == piece_color else -outcome)
+    return outcomes
+
+
+def game_value(board, winner):
+    """1 for a single game, 2 for a gammon and 3 for a backgammon."""
+    if winner == color.WHITE:
+        loser, home = color.RED, range(19, 25)
+    else:
+        loser, home = color.WHITE, range(1, 7)
+    if board.off_count(loser):
+        return 1
+    if board.bar_count(loser) or any(board.color_count(i, loser)
+                                     for i in home):
+        return 3
+    return 2
+
+
+def rollout_iter(counts, piece_color, trials, seed=0, workers=None,
+                 chunk_size=64, policy='random', stratify=False,
+                 antithetic=False):
+    """Yield the `RolloutResult` so far as every chunk of trials ends.
+
+    Closing the generator cancels the trials which are not started yet.
+    Chunk size should be even for antithetic trials, so that pairs are
+    never split between chunks.
+    """
+    options = policy, stratify, antithetic
+    chunks = [range(start, min(start + chunk_size, trials))
+              for start in range(0, trials, chunk_size)]
+    result = RolloutResult()
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        for chunk in chunks:
+            result.add(play_trials(counts, piece_color, seed, chunk, *options))
+            yield result
+        return
+    executor = ProcessPoolExecutor(workers)
+    futures = []
+    try:
+        futures = [
+            executor.submit(play_trials, counts, piece_color, seed, chunk,
+                            *options)
+            for chunk in chunks
+        ]
+        for future in as_completed(futures):
+            result.add(future.result())
+            yield result
+    finally:
+        # shutdown(cancel_futures=True) needs Python 3.9.
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def rollout(counts, piece_color, trials, seed=0, workers=None,
+            max_error=None, **kwargs):
+    """Roll the position out, stop early when all intervals are narrow."""
+    result = RolloutResult()
+    results = rollout_iter(counts, piece_color, trials, seed, workers,
+                           **kwargs)
+    for result in results:
+        if (max_error is not None and
+                max(result.confidence().values()) <= max_error):
+            results.close()
+            break
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trials', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-error', type=float, default=None)
+    parser.add_argument('--color', choices=(color.WHITE, color.RED),
+                        default=color.WHITE)
+    parser.add_argument('--policy', choices=POLICIES, default='random')
+    parser.add_argument('--stratify', action='store_true',
+                        help='spread first rolls evenly over the trials')
+    parser.add_argument('--antithetic', action='store_true',
+                        help='play trials in pairs with mirrored dice')
+    args = parser.parse_args()
+    result = rollout(Board().counts, args.color, args.trials, args.seed,
+                     args.workers, args.max_error, policy=args.policy,
+                     stratify=args.stratify, antithetic=args.antithetic)
+    print(result)
+    for name, error in result.confidence().items():
+        print(f'{name:>16}: +-{error:.4f}')
+    print(f'{"equity":>16}: +-{result.equity_error():.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,143 +3,1191 @@
 # Protocol), which is entirely plain text. The messages of BGP are:
 #
 # Client -> Server
-#   DIES <i> <i>
+#   LOBBY <s>
+#   RATE <i>
+#   VERSION <i>
+#   DIES <i> <i>  (ignored, dies are rolled by the server)
 #   MOVE <i> <i>
 #   ENDMOVE
+#   PONG
 #   QUIT
 #
 # Server -> Client
+#   VERSION <i>
 #   COLOR <c>
 #   DIES <i> <i>
 #   MOVE <i> <i>
 #   ENDMOVE
+#   PING
 #   QUIT
 #
 # Message's size is 10 byte.
+#
+# As the server rolls the dies, a client sends VERSION before it gets a
+# color; VERSION 1 keeps the messages above. Older clients, which roll
+# the dies themselves and never send VERSION, get QUIT after the first
+# 0.1 s instead of a game they would play with other dies.
+#
+# A player sending VERSION 2 before it gets a color switches to version
+# 2 of BGP (see bgp2.py), where messages are short binary frames and
+# TURN carries a whole turn: from the player all its moves instead of
+# MOVEs and ENDMOVE, and to the opponent the moves and the next dies.
+# Players of both versions can play each other.
+#
+# Players of version 2 get a SESSION token with their color. When the
+# connection of such a player drops, its seat is kept for 30 s
+# (--resume-grace); a new connection sending VERSION 2 and RESUME with
+# the token takes it back and gets a SNAPSHOT: the position at the start
+# of the turn, the dies and the moves of the turn so far. Messages sent
+# meanwhile are dropped, the snapshot covers them. The opponent gets
+# QUIT when the grace period is over.
+#
+# RESUME and WATCH must come with VERSION 2, without waiting for the
+# reply: a connection still choosing after JOIN_GRACE is paired. One that
+# sends them once it has been paired gives up the game it has got.
+#
+# A player leaving while it is being paired never gets a game: its
+# opponent goes back to waiting instead.
+#
+# Every game gets a number, logged when it starts. Any number of clients
+# of version 2 may WATCH a game instead of playing. The moves of the game
+# are encoded once and added to the pending bytes of every observer,
+# which are written by the observer's own thread (or task) in one write,
+# so a slow observer never blocks the players. An observer falling more
+# than 16 KiB behind gets a SNAPSHOT instead of the messages it missed.
+# Observers are not read from; they stop watching by closing the
+# connection.
+#
+# The server sends PING to a player it has sent nothing to for 15 s and
+# the player answers PONG. A player that answers PINGs (every player of
+# version 2, and of version 1 once it has sent PONG) and has sent nothing
+# for 60 s (--idle-timeout) is disconnected, and a player of version 2 may
+# resume its game later. Clients ignoring PING are dropped only when
+# writing to them fails or their turn times out. A player who does not
+# finish its turn within 300 s (--turn-timeout) loses: both players
+# get QUIT. At most 64 KiB wait to be sent to a player; a player not
+# reading them is disconnected, so slow or dead clients never hold the
+# server up.
+#
+# With --journal every game, its dies and its checked moves are appended
+# to a journal in the directory, which is written and synced every 5 ms.
+# A restarted server rebuilds the games of the journal; their players
+# take them back with RESUME within the grace period.
+#
+# A new player may send LOBBY (up to 4 characters) and RATE within the
+# first 0.1 s to wait in that lobby or for a close rating; otherwise it
+# waits in the default lobby without a rating. Both can be changed while
+# waiting for the opponent.
+#
+# The server keeps the game of every couple. It rolls the dies for every
+# turn and sends them to both players, and it checks every MOVE and
+# ENDMOVE before passing it to the opponent. A player making an illegal
+# move is disconnected and its opponent gets QUIT.
+#
+# By default every player is served by its own thread. With --asyncio
+# all players are served by one asyncio event loop.
+#
+# Connections and messages are logged as JSON lines by a background
+# thread; --log-sample and --no-log make the log cheaper on busy servers.
+#
+# Connections, couples, messages by command, relay latency from receiving
+# a message to writing it to the opponent, waiting for an opponent and
+# errors by type are counted in memory. --metrics-port serves them as
+# text on localhost and --metrics-file writes them to a file regularly.
 
 
+import os
 import sys
+import asyncio
+import argparse
+import itertools
 import threading
 import socketserver
 import random
+import select
+import socket
+import time
+
+from events import EventLog, parse_sampling
+from matchmaking import Matchmaker
+import journal
+from metrics import Registry, serve_http, write_snapshots
+from sessions import TOKEN_SIZE, Sessions
+
+# The game engine lives in the client's directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import backgammon  # noqa: E402
+import bgp2  # noqa: E402
+import codec  # noqa: E402
+from bgp_client import (dies_message, end_move_message,  # noqa: E402
+                        move_message, parse_message, ping_message,
+                        quit_message)
 
 
 WHITE = 'W'
 RED = 'R'
 
+SWEEP_INTERVAL = 1.0
+JOIN_GRACE = 0.1
+RESUME_GRACE = 30.0
+OBSERVER_BUFFER = 16384
+OUTPUT_BUFFER = 65536
+HEARTBEAT_INTERVAL = 15.0
+IDLE_TIMEOUT = 60.0
+TURN_TIMEOUT = 300.0
+
+MATCHMAKER = Matchmaker()
+SESSIONS = Sessions(RESUME_GRACE)
+JOURNAL = None
+# Connected players and observers.
+CONNECTIONS = set()
+EVENTS = EventLog()
+METRICS = Registry()
+
 
 class QuitMessageException(Exception):
     pass
 
 
-class PlayersCouple:
-    _first_connected_player = None
-    _couple_lock = threading.Lock()
-    _colors = [WHITE, RED]
+class IllegalMoveException(ValueError):
+    pass
+
 
-    def __init__(self):
-        self.current_player = None
+class Games:
+    """Running games by number, for observers."""
+    def __init__(self, numbers=None):
+        self._numbers = numbers or itertools.count(1)
+        self._couples = {}
         self._lock = threading.Lock()
 
+    def __len__(self):
+        return len(self._couples)
+
+    def add(self, couple, number=None):
+        """Return the number of the game, a new one unless given."""
+        with self._lock:
+            while number is None or number in self._couples:
+                number = next(self._numbers)
+            self._couples[number] = couple
+        return number
+
+    def couples(self):
+        with self._lock:
+            return list(self._couples.values())
+
+    def remove(self, number):
+        with self._lock:
+            self._couples.pop(number, None)
+
+    def get(self, number):
+        with self._lock:
+            return self._couples.get(number)
+
+    def route(self, player, number):
+        """Pass an observer of an unknown game to its server.
+
+        Return whether the connection has been passed on; one server
+        has nowhere to pass it.
+        """
+        return False
+
+
+GAMES = Games()
+# Held while a player joins a lobby or leaves; see `PlayersCouple.start`.
+PAIRING = threading.Lock()
+
+
+class PlayersCouple:
+    def __init__(self, player1, player2, colors=None):
+        if colors is None:
+            colors = [WHITE, RED]
+            random.shuffle(colors)
+        player1._color, player2._color = colors
+        player1._opponent = player2
+        player2._opponent = player1
+        player1._couple = self
+        player2._couple = self
+        if player1._color == WHITE:
+            self.current_player = player1
+        else:
+            self.current_player = player2
+        self.game = backgammon.Backgammon()
+        self.turn_counts = None
+        self.dies = None
+        self.turn_started = None
+        self.number = None
+        self.observers = set()
+        # Held while a message of a player is processed.
+        self._lock = threading.RLock()
+        self._finished = False
+        now = time.monotonic()
+        for player in (player1, player2):
+            if player._queued_at is not None:
+                METRICS.histogram('bgp_queue_wait_seconds').observe(
+                    now - player._queued_at
+                )
+        METRICS.gauge('bgp_couples_active').inc()
+
+    def finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            for player in (self.current_player, self.current_player._opponent):
+                if player._token is not None:
+                    SESSIONS.close(player._token)
+            if self.number is not None:
+                GAMES.remove(self.number)
+                self._journal(journal.END)
+            self._broadcast(codec.QUIT_FRAME)
+        METRICS.gauge('bgp_couples_active').dec()
+
     def switch_current(self):
         with self._lock:
             self.current_player = self.current_player._opponent
 
-    @classmethod
-    def join(cls, player):
-        with cls._couple_lock:
-            if cls._first_connected_player is None:
-                random.shuffle(cls._colors)
-                player._color = cls._colors[0]
-                player._couple = None
-                cls._first_connected_player = player
+    def start(self):
+        with self._lock:
+            player = self.current_player
+            # A player may leave between being paired and here.
+            if player._closed or player._opponent._closed:
+                self._abandon()
+                return
+            player.send_color()
+            player._opponent.send_color()
+            self.number = GAMES.add(self)
+            self._journal(journal.STATE, self.state())
+            self.roll_dice()
+        EVENTS.log('started', game=self.number,
+                   white=player.client_address,
+                   red=player._opponent.client_address)
+
+    def _abandon(self):
+        """Drop a couple one of whose players has left; the other waits again."""
+        self._finished = True
+        METRICS.gauge('bgp_couples_active').dec()
+        player = self.current_player
+        for player in (player, player._opponent):
+            player._couple = player._opponent = player._color = None
+            if not player._closed:
+                EVENTS.log('requeued', address=player.client_address)
+                player._join()
+
+    def watch(self, observer):
+        with self._lock:
+            if self._finished:
+                return False
+            self.observers.add(observer)
+        METRICS.gauge('bgp_observers_active').inc()
+        return True
+
+    def unwatch(self, observer):
+        with self._lock:
+            if observer not in self.observers:
+                return
+            self.observers.remove(observer)
+        METRICS.gauge('bgp_observers_active').dec()
+
+    def state(self):
+        """STATE record of the game for the journal."""
+        white = self.current_player
+        if white._color != WHITE:
+            white = white._opponent
+        tokens = (white._token or bytes(TOKEN_SIZE),
+                  white._opponent._token or bytes(TOKEN_SIZE))
+        if not self.game.history:
+            return journal.state_record(tokens, self.current_player._color,
+                                        (0, 0), self.game.board.counts, ())
+        return journal.state_record(tokens, self.current_player._color,
+                                    self.dies, self.turn_counts,
+                                    self.game.moves)
+
+    def snapshot(self, piece_color):
+        """SNAPSHOT frame of the game for the player of `piece_color`."""
+        return bgp2.snapshot_frame(piece_color, self.game.color, self.dies,
+                                   self.turn_counts, self.game.moves)
+
+    def roll_dice(self):
+        dies = self._roll()
+        self.current_player.send_dies(*dies)
+        self.current_player._opponent.send_dies(*dies)
+        self._broadcast(codec.DIES_FRAMES[dies])
+
+    def move(self, from_point, to_point):
+        self._move(from_point, to_point)
+        self.current_player._opponent.send_move(from_point, to_point)
+        self._broadcast(codec.MOVE_FRAMES[from_point, to_point])
+
+    def end_move(self):
+        self._end_move()
+        self.current_player._opponent.send_end_move()
+        self._broadcast(codec.END_MOVE_FRAME)
+        self.switch_current()
+        self.roll_dice()
+
+    def turn(self, moves):
+        """Check and pass on all moves of the turn at once."""
+        player = self.current_player
+        for from_point, to_point in moves:
+            self._move(from_point, to_point)
+        if self.game.game_over:
+            player._opponent.send_turn(moves)
+            self._broadcast(bgp2.turn_frame(moves))
+            return
+        self._end_move()
+        self.switch_current()
+        dies = self._roll()
+        player._opponent.send_turn(moves, dies)
+        player.send_dies(*dies)
+        self._broadcast(bgp2.turn_frame(moves, dies))
+
+    def _broadcast(self, message):
+        for observer in self.observers:
+            observer._feed(message)
+
+    def _roll(self):
+        roll = backgammon.Roll()
+        self.turn_started = time.monotonic()
+        self.turn_counts = self.game.board.counts
+        self.game.roll_dice(roll)
+        self.dies = roll.die1, roll.die2
+        self._journal(journal.DIES, bytes(self.dies))
+        return self.dies
+
+    def _move(self, from_point, to_point):
+        if not self.game.is_possible_move(from_point, to_point):
+            raise IllegalMoveException(
+                f'Illegal move: {from_point} {to_point}'
+            )
+        self.game.move(from_point, to_point)
+        self._journal(journal.MOVE, bytes((from_point, to_point)))
+
+    def _end_move(self):
+        if self.game.can_move:
+            raise IllegalMoveException('Not all dies are used')
+        self._journal(journal.ENDMOVE)
+
+    def _journal(self, kind, arguments=b''):
+        if JOURNAL is not None:
+            JOURNAL.append(self.number, kind, arguments)
+
+
+class Player:
+    """BGP logic of one connected player, whatever the transport is.
+
+    Subclasses implement `_write`, which must not block the caller for
+    long, because a player sends messages to the opponent's connection,
+    and `_disconnect`, which closes the connection from any thread.
+    """
+    _color = None
+    _couple = None
+    _opponent = None
+    _lobby = ''
+    _rating = None
+    _queued = False
+    _queued_at = None
+    _version = 1
+    _token = None
+    _detached = False
+    _quit = False
+    _watching = None
+    _behind = False
+    _received_at = None
+    _sent_at = None
+    _answers_ping = False
+    _closed = False
+    _negotiated = False
+
+    def send(self, message):
+        # The opponent notices a lost connection itself.
+        if self._detached:
+            return
+        try:
+            self._write(message)
+        except OSError as e:
+            EVENTS.log('error', address=self.client_address, error=repr(e))
+        self._sent_at = time.monotonic()
+
+    def send_ping(self):
+        if self._version == 2:
+            self.send(codec.PING_FRAME)
+        else:
+            self.send(ping_message())
+
+    def send_color(self):
+        if self._version == 2:
+            self._token = SESSIONS.open(self)
+            self.send(codec.COLOR_FRAMES[self._color] +
+                      bgp2.session_frame(self._token))
+        else:
+            self.send(color_message(self._color))
+
+    def send_dies(self, die1, die2):
+        if self._version == 2:
+            self.send(codec.DIES_FRAMES[die1, die2])
+        else:
+            self.send(dies_message(die1, die2))
+
+    def send_move(self, from_point, to_point):
+        if self._version == 2:
+            self.send(codec.MOVE_FRAMES[from_point, to_point])
+        else:
+            self.send(move_message(from_point, to_point))
+
+    def send_end_move(self):
+        if self._version == 2:
+            self.send(codec.END_MOVE_FRAME)
+        else:
+            self.send(end_move_message())
+
+    def send_quit(self):
+        if self._version == 2:
+            self.send(codec.QUIT_FRAME)
+        else:
+            self.send(quit_message())
+
+    def send_turn(self, moves, dies=None):
+        """The opponent's turn and the dies of the next, None if it has won."""
+        if self._version == 2:
+            self.send(bgp2.turn_frame(moves, dies or (0, 0)))
+            return
+        for from_point, to_point in moves:
+            self.send_move(from_point, to_point)
+        if dies is not None:
+            self.send_end_move()
+            self.send_dies(*dies)
+
+    def _write(self, message):
+        """Send without blocking; disconnect if too much is waiting."""
+        raise NotImplementedError
+
+    def _disconnect(self):
+        raise NotImplementedError
+
+    def _disconnect_slow(self):
+        EVENTS.log('slow', address=self.client_address)
+        METRICS.counter('bgp_timeouts', type='slow').inc()
+        self._disconnect()
+
+    def _connect(self):
+        self._received_at = self._sent_at = time.monotonic()
+        CONNECTIONS.add(self)
+
+    def _feed(self, message):
+        """Add a message of the watched game, called under its lock."""
+        raise NotImplementedError
+
+    def _queue(self, message):
+        if self._behind:
+            return
+        if len(self._pending) + len(message) > OBSERVER_BUFFER:
+            self._pending.clear()
+            self._behind = True
+            METRICS.counter('bgp_observer_resyncs').inc()
+        else:
+            self._pending += message
+
+    def _take(self):
+        """Pending bytes of an observer, called under the game's lock.
+
+        An observer that has fallen behind gets a snapshot instead.
+        """
+        couple = self._watching
+        if self._behind:
+            self._behind = False
+            self._pending += couple.snapshot(WHITE)
+            if couple._finished:
+                self._pending += codec.QUIT_FRAME
+        data = bytes(self._pending)
+        self._pending.clear()
+        return data
+
+    def _initialize(self):
+        self._queued_at = time.monotonic()
+        # A resumed player is back in its game, an observer never plays.
+        if self._couple is None and self._watching is None:
+            # Without VERSION it is an old client rolling its own dies.
+            if not self._negotiated:
+                EVENTS.log('refused', address=self.client_address)
+                self.send_quit()
+                raise QuitMessageException()
+            self._join()
+
+    def _join(self):
+        with PAIRING:
+            # A closed player must not wait for an opponent.
+            if self._closed:
+                return
+            self._queued = True
+            opponent = MATCHMAKER.join(self, self._lobby, self._rating)
+        if opponent is not None:
+            PlayersCouple(opponent, self).start()
+
+    def _leave(self):
+        with PAIRING:
+            self._closed = True
+            if self._queued:
+                MATCHMAKER.cancel(self, self._lobby)
+        if self._watching is not None:
+            self._watching.unwatch(self)
+        couple = self._couple
+        if couple is None:
+            return
+        with couple._lock:
+            if self._detached or couple._finished:
+                return
+            # Not started yet: `PlayersCouple.start` finds this player gone.
+            if couple.number is None:
+                return
+            playing = not self._quit and not couple.game.game_over
+            if playing and self._token is not None:
+                self._detached = True
+                SESSIONS.detach(self._token)
+                EVENTS.log('detached', address=self.client_address)
+                return
+            if playing:
+                self._opponent.send_quit()
+            couple.finish()
+
+    def _resume(self, token):
+        """Take the seat of the token's player back from its old connection."""
+        if self._queued and not MATCHMAKER.cancel(self, self._lobby):
+            raise ValueError('Paired before RESUME')
+        player = SESSIONS.resume(token)
+        if player is None:
+            if not SESSIONS.route(self, token):
+                self.send_quit()
+            raise QuitMessageException()
+        couple = player._couple
+        with couple._lock:
+            if couple._finished:
+                self.send_quit()
+                raise QuitMessageException()
+            if not player._detached:
+                player._detached = True
+                player._disconnect()
+            self._color = player._color
+            self._couple = couple
+            self._opponent = player._opponent
+            self._token = token
+            self._opponent._opponent = self
+            if couple.current_player is player:
+                couple.current_player = self
+            SESSIONS.replace(token, self)
+            self.send(couple.snapshot(self._color))
+        EVENTS.log('resumed', address=self.client_address)
+        METRICS.counter('bgp_resumes').inc()
+
+    def _watch(self, number):
+        if self._queued and not MATCHMAKER.cancel(self, self._lobby):
+            raise ValueError('Paired before WATCH')
+        couple = GAMES.get(number)
+        if couple is None:
+            if not GAMES.route(self, number):
+                self.send_quit()
+            raise QuitMessageException()
+        # The first write is a snapshot.
+        self._pending = bytearray()
+        self._behind = True
+        self._watching = couple
+        if not couple.watch(self):
+            self.send_quit()
+            raise QuitMessageException()
+        EVENTS.log('watching', address=self.client_address, game=number)
+
+    def _parse(self, message):
+        """Message of a version 1 message or a version 2 frame body."""
+        if self._version == 2:
+            return codec.parse_frame(message)
+        # Messages of the game are known, the others are checked first.
+        if (message not in codec.MESSAGES and
+                not self._is_message_valid(message)):
+            raise ValueError(f'Invalid protocol message: {message}')
+        return parse_message(message)
+
+    def _process_message(self, message):
+        received = time.perf_counter()
+        self._received_at = time.monotonic()
+        EVENTS.log('received', address=self.client_address, message=message)
+        message = self._parse(message)
+        command = message['command']
+        METRICS.counter('bgp_messages', command=command).inc()
+        if command == 'PONG':
+            self._answers_ping = True
+            return
+        if self._couple is None:
+            self._process_waiting_message(message)
+            return
+        with self._couple._lock:
+            if command == 'QUIT':
+                self._quit = True
+                self._opponent.send_quit()
+                observe_relay(received)
+                raise QuitMessageException()
+            if command in {'RESUME', 'WATCH'}:
+                # Paired before the message came, the new game is given
+                # up at once rather than left to a client that will not
+                # play it.
+                self._quit = True
+                self._opponent.send_quit()
+                self.send_quit()
+                raise ValueError(f'Paired before {command}')
+            elif self == self._couple.current_player:
+                try:
+                    if command == 'MOVE':
+                        self._couple.move(*message['args'])
+                    elif command == 'ENDMOVE':
+                        self._couple.end_move()
+                    elif command == 'TURN':
+                        self._couple.turn(message['moves'])
+                except IllegalMoveException:
+                    self._quit = True
+                    self._opponent.send_quit()
+                    raise
+                observe_relay(received)
+
+    def _process_waiting_message(self, message):
+        command = message['command']
+        if command == 'QUIT':
+            raise QuitMessageException()
+        if command == 'VERSION':
+            self._version = 2 if message['arg'] == 2 else 1
+            self._negotiated = True
+            self.send(bgp2.VERSION_MESSAGE if self._version == 2
+                      else b'VERSION 1 ')
+        elif command == 'RESUME':
+            self._resume(message['arg'])
+        elif command == 'WATCH':
+            self._watch(message['arg'])
+        elif command in {'LOBBY', 'RATE'}:
+            lobby, rating = self._lobby, self._rating
+            if command == 'LOBBY':
+                lobby = message['arg']
             else:
-                player1 = cls._first_connected_player
-                player2 = player
-                player2._color = cls._colors[1]
-                player1._opponent = player2
-                player2._opponent = player1
-                couple = PlayersCouple()
-                if player1._color == WHITE:
-                    couple.current_player = player1
-                else:
-                    couple.current_player = player2
-                player1._couple = couple
-                player2._couple = couple
-                cls._first_connected_player = None
+                rating = message['arg']
+            if not self._queued:
+                self._lobby, self._rating = lobby, rating
+            # Cancelling fails when the sweeper has just found an opponent.
+            elif MATCHMAKER.cancel(self, self._lobby):
+                self._lobby, self._rating = lobby, rating
+                self._join()
+        else:
+            raise ValueError(f'No opponent yet: {message}')
+
+    @staticmethod
+    def _is_message_valid(message):
+        message = message.decode('utf-8')
+        return (message.startswith('LOBBY') or
+                message.startswith('RATE') or
+                message.startswith('VERSION') or
+                message.startswith('DIES') or
+                message.startswith('MOVE') or
+                message.startswith('ENDMOVE') or
+                message.startswith('PONG') or
+                message.startswith('QUIT'))
+
+
+class RestoredPlayer(Player):
+    """Seat in a game rebuilt from the journal, until its player resumes."""
+    _detached = True
+    client_address = None
+
+    def _write(self, message):
+        pass
+
+    def _disconnect(self):
+        pass
 
 
 class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
+    request_queue_size = 4096
 
 
-class PlayerHandler(socketserver.StreamRequestHandler):
-    _color = None
-    _couple = None
-    _opponent = None
+class PlayerHandler(Player, socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self._ready = threading.Condition()
+        self._decoder = bgp2.Decoder()
+        # Bytes the socket has not taken at once, sent by `_flush`.
+        self._output = bytearray()
+        self._output_lock = threading.Lock()
+        self._flushing = False
 
     def handle(self):
-        print(f'Connected: {self}')
+        EVENTS.log('connected', address=self.client_address)
+        count_connection()
+        self._connect()
         try:
+            self._choose_lobby()
             self._initialize()
             self._process_messages()
         except QuitMessageException:
             pass
         except Exception as e:
-            print(e)
-        print(f'Closed: {self}')
+            EVENTS.log('error', address=self.client_address, error=repr(e))
+            METRICS.counter('bgp_errors', type=type(e).__name__).inc()
+        finally:
+            CONNECTIONS.discard(self)
+            self._leave()
+            METRICS.gauge('bgp_connections_active').dec()
+        EVENTS.log('closed', address=self.client_address)
 
     def __str__(self):
         return f'{self.client_address} on {threading.current_thread().name}'
 
-    def send(self, message):
-        message = message.encode('utf-8')
-        self.wfile.write(message)
-        print(f'Sent {message}: {self}')
+    def _write(self, message):
+        with self._output_lock:
+            rest = message
+            if not self._flushing:
+                try:
+                    sent = self.connection.send(message, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    sent = 0
+                rest = message[sent:]
+                if rest:
+                    self._flushing = True
+                    threading.Thread(target=self._flush, daemon=True).start()
+            if len(self._output) + len(rest) > OUTPUT_BUFFER:
+                self._output.clear()
+                self._disconnect_slow()
+                return
+            self._output += rest
+        EVENTS.log('sent', address=self.client_address, message=message)
 
-    def _initialize(self):
-        PlayersCouple.join(self)
-        if self._couple:
-            self.send(color_message(self._color))
-            self._opponent.send(color_message(self._opponent._color))
+    def _flush(self):
+        while True:
+            with self._output_lock:
+                if not self._output:
+                    self._flushing = False
+                    return
+                message = bytes(self._output)
+                self._output.clear()
+            try:
+                self.connection.sendall(message)
+            except OSError:
+                # Later messages pile up until the connection is closed.
+                self._disconnect()
+                return
 
-    def _process_messages(self):
+    def _disconnect(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _feed(self, message):
+        with self._ready:
+            self._queue(message)
+            self._ready.notify()
+
+    def _observe(self):
+        couple = self._watching
         while True:
-            message = self.rfile.read(10)
+            with couple._lock, self._ready:
+                message = self._take()
+                finished = couple._finished
+            # Observers wait for their own writes.
+            self.wfile.write(message)
+            if finished:
+                return
+            with self._ready:
+                self._ready.wait_for(lambda: self._pending or self._behind)
+
+    def _choose_lobby(self):
+        deadline = time.monotonic() + JOIN_GRACE
+        # A resumed player or an observer has nothing to choose.
+        while self._couple is None and self._watching is None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            # Messages received with an earlier one are already there.
+            if not self._decoder.has_message(self._version):
+                readable, _, _ = select.select([self.connection], [], [],
+                                               timeout)
+                if not readable:
+                    return
+            message = self._read_message()
             if not message:
-                break
+                raise QuitMessageException()
             self._process_message(message)
 
-    def _process_message(self, message):
-        print(f'Received {message}: {self}')
-        if self._is_message_valid(message):
-            message = message.decode('utf-8')
-            if message.startswith('QUIT'):
-                self._opponent.send(message)
-                raise QuitMessageException()
-            elif self == self._couple.current_player:
-                if message.startswith('ENDMOVE'):
-                    self._couple.switch_current()
-                self._opponent.send(message)
+    def _process_messages(self):
+        while self._watching is None:
+            message = self._read_message()
+            if not message:
+                return
+            self._process_message(message)
+        self._observe()
+
+    def _read_message(self):
+        message = self._decoder.decode(self._version)
+        while message is None:
+            if not self._decoder.receive(self.connection):
+                return b''
+            message = self._decoder.decode(self._version)
+        return message
+
+
+class AsyncPlayer(Player):
+    """Player served by the asyncio event loop.
+
+    All players share one thread, so `_write` only puts the message into
+    the transport buffer of the connection and never waits.
+    """
+    _released = False
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._task = None
+        self._ready = asyncio.Event()
+        self._decoder = bgp2.Decoder()
+        self.client_address = writer.get_extra_info('peername')
+
+    def __str__(self):
+        return f'{self.client_address} on event loop'
+
+    async def handle(self, adopted=False):
+        """Serve the player; an adopted one has already chosen a lobby."""
+        self._task = asyncio.current_task()
+        if adopted:
+            METRICS.gauge('bgp_connections_active').inc()
         else:
-            raise ValueError(f'Invalid protocol message: {message}')
+            EVENTS.log('connected', address=self.client_address)
+            count_connection()
+        self._connect()
+        cancelled = False
+        try:
+            if not adopted:
+                await self._choose_lobby()
+                self._initialize()
+            await self._process_messages()
+        except QuitMessageException:
+            pass
+        except asyncio.CancelledError:
+            cancelled = True
+            if not self._released:
+                raise
+        except Exception as e:
+            EVENTS.log('error', address=self.client_address, error=repr(e))
+            METRICS.counter('bgp_errors', type=type(e).__name__).inc()
+        finally:
+            CONNECTIONS.discard(self)
+            # A released connection is served by another process now,
+            # the game of a stopping server is kept by its journal.
+            if not self._released:
+                if not cancelled:
+                    self._leave()
+                self._writer.close()
+            METRICS.gauge('bgp_connections_active').dec()
+        EVENTS.log('closed', address=self.client_address)
 
-    @staticmethod
-    def _is_message_valid(message):
-        message = message.decode('utf-8')
-        return (message.startswith('DIES') or
-                message.startswith('MOVE') or
-                message.startswith('ENDMOVE') or
-                message.startswith('QUIT'))
+    def _write(self, message):
+        if self._writer.transport.is_closing():
+            return
+        waiting = self._writer.transport.get_write_buffer_size()
+        if waiting + len(message) > OUTPUT_BUFFER:
+            self._disconnect_slow()
+            return
+        self._writer.write(message)
+        EVENTS.log('sent', address=self.client_address, message=message)
+
+    def _disconnect(self):
+        self._writer.transport.abort()
+
+    def _feed(self, message):
+        self._queue(message)
+        self._ready.set()
+
+    async def _observe(self):
+        couple = self._watching
+        while True:
+            with couple._lock:
+                message = self._take()
+                finished = couple._finished
+            self._ready.clear()
+            self._writer.write(message)
+            await self._writer.drain()
+            if finished:
+                return
+            await self._ready.wait()
+
+    async def _choose_lobby(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + JOIN_GRACE
+        # A resumed player or an observer has nothing to choose.
+        while self._couple is None and self._watching is None:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return
+            try:
+                message = await asyncio.wait_for(self._read_message(),
+                                                 timeout)
+            except asyncio.TimeoutError:
+                return
+            except asyncio.IncompleteReadError:
+                raise QuitMessageException()
+            self._process_message(message)
+
+    async def _process_messages(self):
+        while self._watching is None:
+            try:
+                message = await self._read_message()
+            except asyncio.IncompleteReadError:
+                return
+            self._process_message(message)
+            await self._writer.drain()
+        await self._observe()
+
+    async def _read_message(self):
+        message = self._decoder.decode(self._version)
+        while message is None:
+            data = await self._reader.read(bgp2.BUFFER_SIZE)
+            if not data:
+                raise asyncio.IncompleteReadError(self._decoder.pending(),
+                                                  None)
+            self._decoder.feed(data)
+            message = self._decoder.decode(self._version)
+        return message
 
 
 def color_message(color):
-    return f'COLOR {color}'.ljust(10, ' ')
+    return codec.COLOR_MESSAGES[color]
+
+
+def count_connection():
+    METRICS.counter('bgp_connections').inc()
+    METRICS.gauge('bgp_connections_active').inc()
+
+
+def observe_relay(received):
+    METRICS.histogram('bgp_relay_seconds').observe(
+        time.perf_counter() - received
+    )
+
+
+def sweep_lobbies():
+    for player1, player2 in MATCHMAKER.sweep():
+        PlayersCouple(player1, player2).start()
+    for player in SESSIONS.expired():
+        couple = player._couple
+        with couple._lock:
+            if not couple._finished:
+                player._opponent.send_quit()
+                couple.finish()
+        EVENTS.log('expired', address=player.client_address)
+
+
+def configure_timeouts(idle, turn):
+    global IDLE_TIMEOUT, TURN_TIMEOUT, HEARTBEAT_INTERVAL
+    IDLE_TIMEOUT, TURN_TIMEOUT = idle, turn
+    # Some PINGs may be lost in full buffers before a player is idle.
+    HEARTBEAT_INTERVAL = min(HEARTBEAT_INTERVAL, idle / 4)
+
+
+def sweep_connections():
+    """Ping quiet players, disconnect idle ones and end slow turns."""
+    now = time.monotonic()
+    for player in list(CONNECTIONS):
+        # Observers are never read from.
+        if player._watching is not None:
+            continue
+        # Silence is no sign of a dead client that never answers PING.
+        answers = player._version == 2 or player._answers_ping
+        if answers and now - player._received_at > IDLE_TIMEOUT:
+            EVENTS.log('idle', address=player.client_address)
+            METRICS.counter('bgp_timeouts', type='idle').inc()
+            player._disconnect()
+        elif now - player._sent_at >= HEARTBEAT_INTERVAL:
+            player.send_ping()
+    for couple in GAMES.couples():
+        with couple._lock:
+            if (couple._finished or couple.turn_started is None or
+                    now - couple.turn_started <= TURN_TIMEOUT):
+                continue
+            player = couple.current_player
+            EVENTS.log('timeout', address=player.client_address,
+                       game=couple.number)
+            METRICS.counter('bgp_timeouts', type='turn').inc()
+            player._quit = True
+            player.send_quit()
+            player._opponent.send_quit()
+            couple.finish()
+            player._disconnect()
+
+
+def open_journal(directory, interval=journal.COMMIT_INTERVAL):
+    """Rebuild the games of the journal and go on writing it."""
+    global JOURNAL
+    games = journal.Journal(directory, interval=interval,
+                            checkpoint=checkpoint_games)
+    restore_games(games)
+    JOURNAL = games
+    JOURNAL.open()
+
+
+def checkpoint_games():
+    for couple in GAMES.couples():
+        with couple._lock:
+            if not couple._finished:
+                couple._journal(journal.STATE, couple.state())
+
+
+def restore_games(games):
+    states = {}
+    for number, kind, arguments in games.replay():
+        if kind == journal.STATE:
+            states[number] = (journal.parse_state(arguments), [])
+        elif kind == journal.END:
+            states.pop(number, None)
+        elif number in states:
+            states[number][1].append((kind, arguments))
+    for number, (state, events) in states.items():
+        restore_game(number, state, events)
+
+
+def restore_game(number, state, events):
+    game = backgammon.Backgammon()
+    game.restart(state['counts'], state['turn'])
+    turn_counts = game.board.counts
+    dies = state['dies'] if state['dies'] != (0, 0) else None
+    if dies is not None:
+        game.roll_dice(backgammon.Roll(*dies))
+    moves = [(journal.MOVE, bytes(move)) for move in state['moves']]
+    for kind, arguments in moves + events:
+        if kind == journal.DIES:
+            turn_counts = game.board.counts
+            dies = tuple(arguments)
+            game.roll_dice(backgammon.Roll(*dies))
+        elif kind == journal.MOVE:
+            game.move(*arguments)
+        elif kind == journal.ENDMOVE:
+            # The next turn has not been rolled before the server stopped.
+            dies = None
+    if game.game_over:
+        return
+    white, red = RestoredPlayer(), RestoredPlayer()
+    couple = PlayersCouple(white, red, colors=(WHITE, RED))
+    couple.game = game
+    couple.turn_counts = turn_counts
+    couple.dies = dies
+    couple.turn_started = time.monotonic()
+    if dies is None and game.history:
+        to_move = RED if game.color == WHITE else WHITE
+    else:
+        to_move = game.color if game.history else state['turn']
+    if to_move == RED:
+        couple.current_player = red
+    if dies is None:
+        couple._roll()
+    couple.number = GAMES.add(couple, number)
+    for player, token in zip((white, red), state['tokens']):
+        if token == bytes(TOKEN_SIZE):
+            token = None
+        player._token = SESSIONS.open(player, token)
+        SESSIONS.detach(player._token)
+    EVENTS.log('restored', game=couple.number)
+
+
+async def serve_asyncio(host, port, backlog=4096, reuse_port=False):
+    async def handle_connection(reader, writer):
+        await AsyncPlayer(reader, writer).handle()
+
+    async def sweep_forever():
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            sweep_lobbies()
+            sweep_connections()
+
+    server = await asyncio.start_server(
+        handle_connection, host, port,
+        reuse_address=True, reuse_port=reuse_port, backlog=backlog
+    )
+    sweeper = asyncio.create_task(sweep_forever())
+    async with server:
+        print('Backgammon server is running on event loop')
+        try:
+            await server.serve_forever()
+        finally:
+            sweeper.cancel()
+
+
+def serve_threading(host, port):
+    def sweep_forever():
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            sweep_lobbies()
+            sweep_connections()
+
+    threading.Thread(target=sweep_forever, daemon=True).start()
+    with ThreadingTCPServer((host, port), PlayerHandler) as server:
+        print('Backgammon server is running')
+        server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backgammon game server')
+    parser.add_argument('address', help='host:port to listen on')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve all players from one event loop '
+                             'instead of a thread per player')
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help='seconds to keep the seat of a disconnected '
+                             'player')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds of silence before a player is '
+                             'disconnected')
+    parser.add_argument('--turn-timeout', type=float, default=TURN_TIMEOUT,
+                        help='seconds a player has for a turn')
+    parser.add_argument('--journal', default=None, metavar='DIRECTORY',
+                        help='keep a journal of the games in the directory '
+                             'and rebuild them on start')
+    parser.add_argument('--journal-interval', type=float,
+                        default=journal.COMMIT_INTERVAL,
+                        help='seconds between syncs of the journal')
+    parser.add_argument('--log-file', default=None,
+                        help='write events to the file instead of stdout')
+    parser.add_argument('--log-sample', action='append', default=[],
+                        metavar='EVENT=RATE',
+                        help='log only this share of the events of the type, '
+                             'e.g. received=0.01')
+    parser.add_argument('--no-log', action='store_true',
+                        help='do not log events at all')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve metrics as text on localhost:PORT')
+    parser.add_argument('--metrics-file', default=None,
+                        help='write metrics to the file regularly')
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help='seconds between writes of --metrics-file')
+    args = parser.parse_args()
+    host, port = args.address.split(':')
+    port = int(port)
+    SESSIONS.grace = args.resume_grace
+    configure_timeouts(args.idle_timeout, args.turn_timeout)
+    if args.log_file:
+        EVENTS.stream = open(args.log_file, 'a')
+    EVENTS.sampling = parse_sampling(args.log_sample)
+    EVENTS.enabled = not args.no_log
+    EVENTS.start()
+    if args.metrics_port is not None:
+        serve_http(METRICS, 'localhost', args.metrics_port)
+    if args.metrics_file:
+        write_snapshots(METRICS, args.metrics_file, args.metrics_interval)
+    if args.journal:
+        open_journal(args.journal, args.journal_interval)
+    try:
+        if args.asyncio:
+            asyncio.run(serve_asyncio(host, port))
+        else:
+            serve_threading(host, port)
+    finally:
+        if JOURNAL is not None:
+            JOURNAL.close()
+        EVENTS.close()
 
 
-host, port = sys.argv[1].split(':')
-port = int(port)
-with ThreadingTCPServer((host, port), PlayerHandler) as server:
-    print('Backgammon server is running')
-    server.serve_forever()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
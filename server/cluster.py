@@ -0,0 +1,452 @@
+# Runs the backgammon server as several worker processes listening on
+# the same host:port with SO_REUSEPORT, so the kernel spreads the
+# connections over all CPU cores (Linux only).
+#
+# Every worker serves its players with the asyncio server of
+# bgp_server.py. Waiting players of all workers are paired by one
+# matchmaker in the launcher process, which talks to every worker over
+# a Unix socket:
+#
+# Worker -> Launcher
+#   join     a player waits for an opponent
+#   cancel   a waiting player has left
+#   handoff  the connection of a released player (or none if it left)
+#   session  a player of a game in this worker has got a session token
+#   closed   the session has ended
+#   route    the connection of a player resuming an unknown session or
+#            watching an unknown game
+#
+# Launcher -> Worker
+#   pair     start a game of two players waiting in this worker
+#   release  hand off the connection of a waiting player
+#   adopt    start a game of a waiting player and a handed off one
+#   resume   let a routed connection take back its seat
+#   watch    let a routed connection watch a game
+#
+# When the players of a couple wait in different workers, the second
+# player's socket is passed to the first player's worker, so a game is
+# always served by one process. A player who leaves meanwhile makes
+# its opponent wait again.
+#
+# Waiting players can change LOBBY and RATE as usual. The launcher may
+# pair the old ticket meanwhile; the opponent then waits again.
+#
+# A player resuming its session usually connects to another worker than
+# the one serving its game. The launcher knows the worker of every
+# session token and passes the connection there. Observers are passed
+# the same way; worker N of W numbers its games N + 1, N + 1 + W, ...
+#
+# With --journal worker N keeps its journal in the subdirectory N, so a
+# restarted cluster of as many workers rebuilds every game in its worker.
+
+
+import os
+import json
+import array
+import socket
+import asyncio
+import argparse
+import itertools
+import multiprocessing
+import select
+import signal
+import sys
+import time
+
+import bgp_server
+from events import parse_sampling
+from matchmaking import Matchmaker
+from metrics import serve_http
+from sessions import Sessions
+
+
+CHANNEL_SIZE = 65536
+
+
+def send_message(channel, message, fd=None):
+    ancillary = []
+    if fd is not None:
+        ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                          array.array('i', [fd])))
+    channel.sendmsg([json.dumps(message).encode('utf-8')], ancillary)
+
+
+def receive_message(channel):
+    """Return the next message and the passed descriptor or None."""
+    fds = array.array('i')
+    data, ancillary, _, _ = channel.recvmsg(
+        CHANNEL_SIZE, socket.CMSG_LEN(fds.itemsize)
+    )
+    if not data:
+        raise EOFError('Channel closed')
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    return json.loads(data.decode('utf-8')), (fds[0] if fds else None)
+
+
+class WorkerMatchmaker:
+    """Matchmaker of a worker, the launcher pairs its players.
+
+    It replaces `bgp_server.MATCHMAKER`, so players never find an
+    opponent at once; games are started by the launcher's messages.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.closed = asyncio.get_running_loop().create_future()
+        self._waiting = {}
+        self._tickets = itertools.count()
+
+    def join(self, player, lobby='', rating=None):
+        ticket = next(self._tickets)
+        player._ticket = ticket
+        self._waiting[ticket] = player
+        send_message(self.channel, {'op': 'join', 'id': ticket,
+                                    'lobby': lobby, 'rating': rating,
+                                    'queued_at': player._queued_at})
+        return None
+
+    def cancel(self, player, lobby=''):
+        if self._waiting.pop(player._ticket, None) is None:
+            return False
+        send_message(self.channel, {'op': 'cancel', 'id': player._ticket})
+        return True
+
+    def sweep(self):
+        return []
+
+    def receive(self):
+        try:
+            message, fd = receive_message(self.channel)
+        except EOFError:
+            if not self.closed.done():
+                self.closed.set_result(None)
+            return
+        if message['op'] == 'pair':
+            player1, player2 = (self._waiting.pop(ticket, None)
+                                for ticket in message['ids'])
+            if player1 is not None and player2 is not None:
+                bgp_server.PlayersCouple(player1, player2).start()
+            else:
+                for player in (player1, player2):
+                    if player is not None:
+                        player._join()
+        elif message['op'] == 'release':
+            player = self._waiting.pop(message['id'], None)
+            if player is None:
+                send_message(self.channel, {'op': 'handoff',
+                                            'id': message['id']})
+            else:
+                asyncio.ensure_future(release(
+                    self.channel, player,
+                    {'op': 'handoff', 'id': player._ticket,
+                     'lobby': player._lobby, 'rating': player._rating,
+                     'queued_at': player._queued_at,
+                     'version': player._version}
+                ))
+        elif message['op'] == 'adopt':
+            asyncio.ensure_future(self._adopt(message, fd))
+        elif message['op'] in {'resume', 'watch'}:
+            asyncio.ensure_future(self._adopt_routed(message, fd))
+
+    async def _adopt(self, message, fd):
+        reader, writer = await asyncio.open_connection(
+            sock=socket.socket(fileno=fd)
+        )
+        guest = message['guest']
+        reader.feed_data(guest['data'].encode('latin-1'))
+        player = bgp_server.AsyncPlayer(reader, writer)
+        player._lobby = guest['lobby']
+        player._rating = guest['rating']
+        player._queued_at = guest['queued_at']
+        player._version = guest['version']
+        bgp_server.EVENTS.log('adopted', address=player.client_address)
+        host = self._waiting.pop(message['id'], None)
+        if host is None:
+            player._join()
+        else:
+            bgp_server.PlayersCouple(host, player).start()
+        await player.handle(adopted=True)
+
+    async def _adopt_routed(self, message, fd):
+        reader, writer = await asyncio.open_connection(
+            sock=socket.socket(fileno=fd)
+        )
+        reader.feed_data(message['data'].encode('latin-1'))
+        player = bgp_server.AsyncPlayer(reader, writer)
+        player._version = message['version']
+        bgp_server.EVENTS.log('adopted', address=player.client_address)
+        try:
+            if message['op'] == 'resume':
+                player._resume(bytes.fromhex(message['token']))
+            else:
+                player._watch(message['game'])
+        except bgp_server.QuitMessageException:
+            writer.close()
+            return
+        await player.handle(adopted=True)
+
+
+class WorkerSessions(Sessions):
+    """Sessions of a worker, the launcher knows where all of them are."""
+    def __init__(self, channel, grace):
+        super().__init__(grace)
+        self.channel = channel
+
+    def open(self, player, token=None):
+        token = super().open(player, token)
+        send_message(self.channel, {'op': 'session', 'token': token.hex()})
+        return token
+
+    def close(self, token):
+        if token in self._players:
+            send_message(self.channel, {'op': 'closed', 'token': token.hex()})
+        super().close(token)
+
+    def expired(self):
+        players = super().expired()
+        for player in players:
+            send_message(self.channel, {'op': 'closed',
+                                        'token': player._token.hex()})
+        return players
+
+    def route(self, player, token):
+        return route(self.channel, player, {'op': 'route',
+                                            'token': token.hex()})
+
+
+class WorkerGames(bgp_server.Games):
+    """Games of a worker, numbered so that the launcher knows the worker."""
+    def __init__(self, channel, index, workers):
+        super().__init__(itertools.count(index + 1, workers))
+        self.channel = channel
+
+    def route(self, player, number):
+        return route(self.channel, player, {'op': 'route', 'game': number})
+
+
+def route(channel, player, message):
+    """Pass the connection of the player to another worker, if any."""
+    # A connection routed here once has no task yet and goes no further.
+    if player._task is None:
+        return False
+    # Set at once, so the player's task keeps the connection open.
+    player._released = True
+    message['version'] = player._version
+    asyncio.ensure_future(release(channel, player, message))
+    return True
+
+
+async def release(channel, player, message):
+    """Pass the connection of the player to the launcher with the message."""
+    player._released = True
+    transport = player._writer.transport
+    transport.pause_reading()
+    player._task.cancel()
+    # Bytes already read from the socket go along with it.
+    player._reader.feed_eof()
+    data = player._decoder.pending() + await player._reader.read()
+    sock = player._writer.get_extra_info('socket')
+    message['data'] = data.decode('latin-1')
+    send_message(channel, message, sock.fileno())
+    transport.abort()
+    bgp_server.EVENTS.log('released', address=player.client_address)
+
+
+async def serve_worker(host, port, channel):
+    matchmaker = WorkerMatchmaker(channel)
+    bgp_server.MATCHMAKER = matchmaker
+    asyncio.get_running_loop().add_reader(channel.fileno(),
+                                          matchmaker.receive)
+    server = asyncio.ensure_future(
+        bgp_server.serve_asyncio(host, port, reuse_port=True)
+    )
+    await asyncio.wait([server, matchmaker.closed],
+                       return_when=asyncio.FIRST_COMPLETED)
+    server.cancel()
+
+
+def run_worker(index, host, port, channel, inherited, options):
+    # Only the launcher may keep the other ends of the channels open,
+    # otherwise workers would not notice that it has stopped.
+    for other in inherited:
+        other.close()
+    if options.log_file:
+        bgp_server.EVENTS.stream = open(options.log_file, 'a')
+    bgp_server.EVENTS.sampling = parse_sampling(options.log_sample)
+    bgp_server.EVENTS.enabled = not options.no_log
+    bgp_server.EVENTS.start()
+    bgp_server.SESSIONS = WorkerSessions(channel, options.resume_grace)
+    bgp_server.GAMES = WorkerGames(channel, index, options.workers)
+    bgp_server.configure_timeouts(options.idle_timeout, options.turn_timeout)
+    if options.journal:
+        bgp_server.open_journal(os.path.join(options.journal, str(index)),
+                                options.journal_interval)
+    if options.metrics_port is not None:
+        serve_http(bgp_server.METRICS, 'localhost',
+                   options.metrics_port + index)
+    try:
+        asyncio.run(serve_worker(host, port, channel))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if bgp_server.JOURNAL is not None:
+            bgp_server.JOURNAL.close()
+        bgp_server.EVENTS.close()
+
+
+class Coordinator:
+    """Pairs the waiting players of all workers."""
+    def __init__(self, channels):
+        self.channels = channels
+        self.matchmaker = Matchmaker()
+        self._tickets = {}
+        self._sessions = {}
+        # Waiting players whose opponent is being handed off to them.
+        self._hosts = {}
+        self._guests = {}
+
+    def serve_forever(self):
+        workers = {channel: worker
+                   for worker, channel in enumerate(self.channels)}
+        next_sweep = time.monotonic() + bgp_server.SWEEP_INTERVAL
+        while True:
+            timeout = max(next_sweep - time.monotonic(), 0)
+            readable, _, _ = select.select(self.channels, [], [], timeout)
+            for channel in readable:
+                message, fd = receive_message(channel)
+                self._process_message(workers[channel], message, fd)
+            if time.monotonic() >= next_sweep:
+                next_sweep += bgp_server.SWEEP_INTERVAL
+                for ticket, opponent in self.matchmaker.sweep():
+                    self._pair(opponent, ticket)
+
+    def _process_message(self, worker, message, fd):
+        ticket = (worker, message.get('id'))
+        if message['op'] == 'session':
+            self._sessions[message['token']] = worker
+        elif message['op'] == 'closed':
+            self._sessions.pop(message['token'], None)
+        elif message['op'] == 'route':
+            if 'token' in message:
+                owner = self._sessions.get(message['token'])
+                message['op'] = 'resume'
+            else:
+                owner = (message['game'] - 1) % len(self.channels)
+                message['op'] = 'watch'
+            try:
+                # The client sees the connection closed for unknown tokens.
+                if owner is not None:
+                    send_message(self.channels[owner], message, fd)
+            finally:
+                os.close(fd)
+        elif message['op'] == 'join':
+            self._join(ticket, message)
+        elif message['op'] == 'cancel':
+            waiting = self._tickets.pop(ticket, None)
+            if waiting is not None:
+                self.matchmaker.cancel(ticket, waiting['lobby'])
+            self._hosts.pop(ticket, None)
+        elif message['op'] == 'handoff':
+            host = self._guests.pop(ticket)
+            if fd is None:
+                waiting = self._hosts.pop(host, None)
+                if waiting is not None:
+                    self._join(host, waiting)
+                return
+            self._hosts.pop(host, None)
+            try:
+                send_message(self.channels[host[0]],
+                             {'op': 'adopt', 'id': host[1], 'guest': message},
+                             fd)
+            finally:
+                os.close(fd)
+
+    def _join(self, ticket, waiting):
+        self._tickets[ticket] = waiting
+        opponent = self.matchmaker.join(ticket, waiting['lobby'],
+                                        waiting['rating'])
+        if opponent is not None:
+            self._pair(opponent, ticket)
+
+    def _pair(self, host, guest):
+        """Start a game in the worker of `host`, who waited longer."""
+        waiting = self._tickets.pop(host)
+        self._tickets.pop(guest)
+        if host[0] == guest[0]:
+            send_message(self.channels[host[0]],
+                         {'op': 'pair', 'ids': [host[1], guest[1]]})
+        else:
+            self._hosts[host] = waiting
+            self._guests[guest] = host
+            send_message(self.channels[guest[0]],
+                         {'op': 'release', 'id': guest[1]})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Backgammon game server on several processes'
+    )
+    parser.add_argument('address', help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of server processes')
+    parser.add_argument('--resume-grace', type=float,
+                        default=bgp_server.RESUME_GRACE,
+                        help='seconds to keep the seat of a disconnected '
+                             'player')
+    parser.add_argument('--idle-timeout', type=float,
+                        default=bgp_server.IDLE_TIMEOUT,
+                        help='seconds of silence before a player is '
+                             'disconnected')
+    parser.add_argument('--turn-timeout', type=float,
+                        default=bgp_server.TURN_TIMEOUT,
+                        help='seconds a player has for a turn')
+    parser.add_argument('--journal', default=None, metavar='DIRECTORY',
+                        help='keep journals of the games in the directory '
+                             'and rebuild them on start')
+    parser.add_argument('--journal-interval', type=float,
+                        default=bgp_server.journal.COMMIT_INTERVAL,
+                        help='seconds between syncs of the journals')
+    parser.add_argument('--log-file', default=None,
+                        help='write events to the file instead of stdout')
+    parser.add_argument('--log-sample', action='append', default=[],
+                        metavar='EVENT=RATE',
+                        help='log only this share of the events of the type, '
+                             'e.g. received=0.01')
+    parser.add_argument('--no-log', action='store_true',
+                        help='do not log events at all')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve metrics of worker N as text on '
+                             'localhost:PORT+N')
+    args = parser.parse_args()
+    assert args.workers >= 1, f'Need at least one worker: {args.workers}'
+    host, port = args.address.split(':')
+    port = int(port)
+    channels, processes = [], []
+    for index in range(args.workers):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_SEQPACKET)
+        process = multiprocessing.Process(
+            target=run_worker, name=f'Worker-{index}', daemon=True,
+            args=(index, host, port, worker_channel, channels + [channel],
+                  args)
+        )
+        process.start()
+        worker_channel.close()
+        channels.append(channel)
+        processes.append(process)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    print(f'Backgammon server is running on {args.workers} processes')
+    try:
+        Coordinator(channels).serve_forever()
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
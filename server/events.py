@@ -0,0 +1,95 @@
+"""Structured event log of the server.
+
+Logging an event only appends a tuple to a bounded queue; a background
+thread formats the events as JSON lines and writes them in batches.
+Every event type can be sampled, and events that do not fit into the
+queue are counted and dropped instead of slowing the server down.
+"""
+import json
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+
+class EventLog:
+    def __init__(self, stream=sys.stdout, maxsize=65536, batch_size=1024,
+                 flush_interval=0.1, sampling=None, enabled=True):
+        self.stream = stream
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sampling = dict(sampling or {})
+        self.enabled = enabled
+        self.dropped = 0
+        self._events = deque()
+        self._closed = threading.Event()
+        self._writer = None
+
+    def log(self, event, **fields):
+        if not self.enabled:
+            return
+        rate = self.sampling.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        if len(self._events) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._events.append((time.time(), event, fields))
+
+    def start(self):
+        if self.enabled and self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_forever, name='EventLog', daemon=True
+            )
+            self._writer.start()
+
+    def close(self):
+        self._closed.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        self.flush()
+
+    def flush(self):
+        while self._events:
+            self._write_batch()
+
+    def _write_forever(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def _write_batch(self):
+        lines = []
+        for _ in range(min(self.batch_size, len(self._events))):
+            timestamp, event, fields = self._events.popleft()
+            record = {'time': round(timestamp, 6), 'event': event}
+            record.update(fields)
+            lines.append(json.dumps(record, default=_to_json))
+        if self.dropped:
+            lines.append(json.dumps({'time': round(time.time(), 6),
+                                     'event': 'dropped',
+                                     'count': self.dropped}))
+            self.dropped = 0
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+
+
+def _to_json(value):
+    if isinstance(value, bytes):
+        text = value.decode('utf-8', 'replace').rstrip()
+        # Binary frames of BGP version 2 are logged in hex.
+        return text if text.isprintable() else value.hex()
+    return str(value)
+
+
+def parse_sampling(specs):
+    """Turn ['received=0.01', ...] into {'received': 0.01, ...}."""
+    sampling = {}
+    for spec in specs:
+        event, rate = spec.split('=')
+        rate = float(rate)
+        assert 0 <= rate <= 1, f'Sampling rate out of range [0..1]: {rate}'
+        sampling[event] = rate
+    return sampling
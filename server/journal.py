@@ -0,0 +1,146 @@
+"""Append-only journal of the games of a server.
+
+Records go to numbered segment files in a directory. Appending only
+adds the record to a buffer; a background thread writes the buffer and
+calls fsync every `interval` seconds (group commit), so one fsync covers
+the records of all games appended meanwhile. Records appended less than
+`interval` before a crash may be lost.
+
+When a segment is larger than `segment_size`, the next one starts with
+a STATE record of every running game made by `checkpoint`, and the
+older segments are deleted.
+
+A record is its length, its CRC-32 and the payload: the number of the
+game, the kind and the arguments. Reading stops at the first damaged
+record, which is where the server has crashed writing.
+"""
+import os
+import struct
+import threading
+import zlib
+
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+COMMIT_INTERVAL = 0.005
+
+STATE, DIES, MOVE, ENDMOVE, END = range(1, 6)
+
+_HEADER = struct.Struct('>II')
+_GAME = struct.Struct('>IB')
+_STATE = struct.Struct('>16s16sc2B26b')
+
+
+def state_record(tokens, turn_color, dies, counts, moves):
+    """Arguments of STATE: the game at `counts`, where `turn_color` moves.
+
+    `tokens` are the session tokens of white and red, `dies` are (0, 0)
+    before the roll.
+    """
+    return (_STATE.pack(*tokens, turn_color.encode('ascii'), *dies, *counts) +
+            bytes(point for move in moves for point in move))
+
+
+def parse_state(arguments):
+    fields = _STATE.unpack_from(arguments)
+    moves = arguments[_STATE.size:]
+    return {'tokens': fields[:2], 'turn': fields[2].decode('ascii'),
+            'dies': fields[3:5], 'counts': fields[5:],
+            'moves': tuple(zip(moves[::2], moves[1::2]))}
+
+
+class Journal:
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 interval=COMMIT_INTERVAL, checkpoint=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.interval = interval
+        # Called on the writer thread to append STATE of every game.
+        self.checkpoint = checkpoint
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._file = None
+        self._writer = None
+        os.makedirs(directory, exist_ok=True)
+
+    def replay(self):
+        """Yield (game, kind, arguments) of all records in order."""
+        for name in self._segments():
+            with open(os.path.join(self.directory, name), 'rb') as segment:
+                data = segment.read()
+            position = 0
+            while position + _HEADER.size <= len(data):
+                size, checksum = _HEADER.unpack_from(data, position)
+                start = position + _HEADER.size
+                payload = data[start:start + size]
+                if (size < _GAME.size or len(payload) < size or
+                        zlib.crc32(payload) != checksum):
+                    break
+                game, kind = _GAME.unpack_from(payload)
+                yield game, kind, payload[_GAME.size:]
+                position = start + size
+
+    def open(self):
+        """Start a new segment with a checkpoint, delete the old ones."""
+        obsolete = self._segments()
+        self._start_segment(obsolete)
+        if self.checkpoint is not None:
+            self.checkpoint()
+        self._commit()
+        self._delete(obsolete)
+        self._writer = threading.Thread(target=self._write_forever,
+                                        name='Journal', daemon=True)
+        self._writer.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._writer is not None:
+            self._writer.join()
+        self._commit()
+        self._file.close()
+
+    def append(self, game, kind, arguments=b''):
+        payload = _GAME.pack(game, kind) + arguments
+        with self._lock:
+            self._buffer += _HEADER.pack(len(payload), zlib.crc32(payload))
+            self._buffer += payload
+
+    def _write_forever(self):
+        while not self._stopped.wait(self.interval):
+            self._commit()
+            if self._file.tell() >= self.segment_size:
+                obsolete = self._segments()
+                self._start_segment(obsolete)
+                if self.checkpoint is not None:
+                    self.checkpoint()
+                self._commit()
+                self._delete(obsolete)
+
+    def _commit(self):
+        with self._lock:
+            data, self._buffer = self._buffer, bytearray()
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _start_segment(self, segments):
+        number = int(segments[-1].split('.')[0]) + 1 if segments else 1
+        if self._file is not None:
+            self._file.close()
+        self._file = open(os.path.join(self.directory,
+                                       f'{number:08d}.journal'), 'ab')
+        # The new file must survive a crash too.
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _delete(self, segments):
+        for name in segments:
+            os.remove(os.path.join(self.directory, name))
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.journal'))
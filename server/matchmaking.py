@@ -0,0 +1,174 @@
+"""Matchmaking of waiting players into couples.
+
+Players wait in named lobbies. Players without a rating are paired in
+the order they came. Rated players wait in buckets of close ratings and
+are paired with the oldest player of the nearest bucket their rating
+windows allow. A window starts at `window` rating points and widens by
+`widening` points every second of waiting, so nobody waits forever.
+Joining, pairing and cancelling take constant time for a given window.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class Ticket:
+    __slots__ = ('player', 'rating', 'joined', 'bucket')
+
+    def __init__(self, player, rating, joined, bucket):
+        self.player = player
+        self.rating = rating
+        self.joined = joined
+        self.bucket = bucket
+
+
+class Lobby:
+    def __init__(self, name, window=100, widening=25, bucket_size=50,
+                 clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.widening = widening
+        self.bucket_size = bucket_size
+        self.clock = clock
+        self._unrated = OrderedDict()
+        self._buckets = {}
+        self._tickets = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'Lobby({self.name!r}, waiting={len(self)})'
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def __contains__(self, player):
+        return player in self._tickets
+
+    def join(self, player, rating=None):
+        """Return the opponent for `player` or None if it has to wait."""
+        with self._lock:
+            assert player not in self._tickets, f'Already waiting: {player}'
+            now = self.clock()
+            if rating is None:
+                if self._unrated:
+                    opponent, _ = self._unrated.popitem(last=False)
+                    del self._tickets[opponent]
+                    return opponent
+                ticket = Ticket(player, None, now, None)
+                self._unrated[player] = ticket
+            else:
+                ticket = Ticket(player, rating, now,
+                                rating // self.bucket_size)
+                opponent = self._nearest(ticket, now)
+                if opponent is not None:
+                    self._remove(opponent)
+                    return opponent.player
+                self._buckets.setdefault(ticket.bucket, OrderedDict())
+                self._buckets[ticket.bucket][player] = ticket
+            self._tickets[player] = ticket
+            return None
+
+    def cancel(self, player):
+        with self._lock:
+            ticket = self._tickets.get(player)
+            if ticket is None:
+                return False
+            self._remove(ticket)
+            return True
+
+    def sweep(self):
+        """Pair rated players whose windows have widened enough."""
+        couples = []
+        with self._lock:
+            now = self.clock()
+            for bucket in sorted(self._buckets):
+                waiting = self._buckets.get(bucket)
+                while waiting:
+                    ticket = next(iter(waiting.values()))
+                    self._remove(ticket)
+                    opponent = self._nearest(ticket, now)
+                    if opponent is None:
+                        self._insert(ticket)
+                        break
+                    self._remove(opponent)
+                    couples.append((ticket.player, opponent.player))
+        return couples
+
+    def _steps(self, ticket, now):
+        window = self.window + self.widening * (now - ticket.joined)
+        return int(window // self.bucket_size)
+
+    def _nearest(self, ticket, now):
+        steps = self._steps(ticket, now)
+        for distance in range(steps + 1):
+            for bucket in {ticket.bucket - distance, ticket.bucket + distance}:
+                waiting = self._buckets.get(bucket)
+                if not waiting:
+                    continue
+                oldest = next(iter(waiting.values()))
+                if self._steps(oldest, now) >= distance:
+                    return oldest
+        return None
+
+    def _insert(self, ticket):
+        self._buckets.setdefault(ticket.bucket, OrderedDict())
+        self._buckets[ticket.bucket][ticket.player] = ticket
+        self._buckets[ticket.bucket].move_to_end(ticket.player, last=False)
+        self._tickets[ticket.player] = ticket
+
+    def _remove(self, ticket):
+        del self._tickets[ticket.player]
+        if ticket.bucket is None:
+            del self._unrated[ticket.player]
+            return
+        waiting = self._buckets[ticket.bucket]
+        del waiting[ticket.player]
+        if not waiting:
+            del self._buckets[ticket.bucket]
+
+
+class Matchmaker:
+    """Lobbies by name, created on first use and dropped once empty."""
+    def __init__(self, **lobby_options):
+        self._lobby_options = lobby_options
+        self._lobbies = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lobbies)
+
+    def lobby(self, name=''):
+        """The lobby of the name, or None if nobody waits there."""
+        return self._lobbies.get(name)
+
+    def join(self, player, lobby='', rating=None):
+        # Locked, so that nobody joins a lobby while it is dropped.
+        with self._lock:
+            lobby = self._lobbies.get(lobby) or Lobby(lobby,
+                                                      **self._lobby_options)
+            opponent = lobby.join(player, rating)
+            self._keep(lobby)
+        return opponent
+
+    def cancel(self, player, lobby=''):
+        with self._lock:
+            lobby = self._lobbies.get(lobby)
+            if lobby is None:
+                return False
+            cancelled = lobby.cancel(player)
+            self._keep(lobby)
+        return cancelled
+
+    def sweep(self):
+        couples = []
+        with self._lock:
+            for lobby in list(self._lobbies.values()):
+                couples.extend(lobby.sweep())
+                self._keep(lobby)
+        return couples
+
+    def _keep(self, lobby):
+        if len(lobby):
+            self._lobbies[lobby.name] = lobby
+        else:
+            self._lobbies.pop(lobby.name, None)
@@ -0,0 +1,161 @@
+"""In-process metrics of the server.
+
+Counters, gauges and histograms are kept in a `Registry` and rendered
+as plain text, one `name{labels} value` line each. The text is served on
+a local HTTP port or written to a snapshot file periodically. Counters
+are also rendered as per second rates since the previous rendering for
+the same reader.
+"""
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Histogram buckets in seconds: 1 us, 2 us, 4 us ... about 67 s.
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(27))
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Counter):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                return float('inf')
+        return float('inf')
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+    def counter(self, name, **labels):
+        return self._metric(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._metric(Gauge, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._metric(Histogram, name, labels)
+
+    def render(self, previous=None):
+        """Metrics as text; `previous` keeps counters for the rates."""
+        if previous is None:
+            previous = {}
+        now = time.monotonic()
+        elapsed = max(now - previous.get(None, self._started), 1e-9)
+        previous[None] = now
+        lines = []
+        metrics = sorted(self._metrics.items(),
+                         key=lambda item: item[0][1:])
+        for (kind, name, labels), metric in metrics:
+            key = _key(name, labels)
+            if kind is Histogram:
+                lines.append(f'{_key(name + "_count", labels)} {metric.count}')
+                lines.append(f'{_key(name + "_sum", labels)} {metric.sum:.6f}')
+                for q in (0.5, 0.9, 0.99):
+                    quantile_labels = labels + (('quantile', q),)
+                    lines.append(f'{_key(name, quantile_labels)} '
+                                 f'{metric.quantile(q):.6f}')
+            else:
+                lines.append(f'{key} {metric.value}')
+            if kind is Counter:
+                rate = (metric.value - previous.get(key, 0)) / elapsed
+                previous[key] = metric.value
+                lines.append(f'{_key(name + "_per_second", labels)} '
+                             f'{rate:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def _metric(self, kind, name, labels):
+        key = (kind, name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, kind())
+        return metric
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    labels = ','.join(f'{label}="{value}"' for label, value in labels)
+    return f'{name}{{{labels}}}'
+
+
+def serve_http(registry, host, port):
+    """Serve the rendered metrics on every GET in a daemon thread."""
+    previous = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render(previous).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='Metrics',
+                     daemon=True).start()
+    return server
+
+
+def write_snapshots(registry, filename, interval):
+    """Replace the file with the rendered metrics every interval."""
+    def write_forever():
+        previous = {}
+        while True:
+            time.sleep(interval)
+            temporary = f'{filename}.tmp'
+            with open(temporary, 'w') as snapshot:
+                snapshot.write(registry.render(previous))
+            os.replace(temporary, filename)
+
+    thread = threading.Thread(target=write_forever, name='MetricsSnapshot',
+                              daemon=True)
+    thread.start()
+    return thread
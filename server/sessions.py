@@ -0,0 +1,75 @@
+"""Sessions of players who may come back to their games.
+
+Every player of a game gets a random token. When its connection drops,
+the player is detached and its seat in the game is kept for `grace`
+seconds; a new connection presenting the token takes the seat back.
+Games must be ended by closing the tokens of both players.
+"""
+import secrets
+import threading
+import time
+
+
+TOKEN_SIZE = 16
+
+
+class Sessions:
+    def __init__(self, grace=30.0, clock=time.monotonic):
+        self.grace = grace
+        self.clock = clock
+        self._players = {}
+        self._detached = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._players)
+
+    def open(self, player, token=None):
+        """Return the token of the player, a new one unless given."""
+        token = token or secrets.token_bytes(TOKEN_SIZE)
+        with self._lock:
+            self._players[token] = player
+        return token
+
+    def close(self, token):
+        with self._lock:
+            self._players.pop(token, None)
+            self._detached.pop(token, None)
+
+    def detach(self, token):
+        with self._lock:
+            if token in self._players:
+                self._detached[token] = self.clock()
+
+    def resume(self, token):
+        """Return the player of the token, or None; it is attached again.
+
+        The player may still seem connected when the client has already
+        noticed that the connection is lost.
+        """
+        with self._lock:
+            self._detached.pop(token, None)
+            return self._players.get(token)
+
+    def route(self, player, token):
+        """Pass a player resuming an unknown session to its server.
+
+        Return whether the connection has been passed on; one server
+        has nowhere to pass it.
+        """
+        return False
+
+    def replace(self, token, player):
+        with self._lock:
+            self._players[token] = player
+
+    def expired(self):
+        """Detached players whose grace period is over; they are closed."""
+        players = []
+        with self._lock:
+            deadline = self.clock() - self.grace
+            for token, detached in list(self._detached.items()):
+                if detached <= deadline:
+                    del self._detached[token]
+                    players.append(self._players.pop(token))
+        return players
@@ -0,0 +1,136 @@
+"""Headless self-play of the backgammon engine.
+
+Plays complete games between two policies without pygame and reports
+games/sec, moves/sec and the time spent in every phase of a turn:
+
+    python simulate.py --games 1000 --seed 1 --white random --red first
+"""
+import argparse
+import random
+import time
+
+import color
+from backgammon import Backgammon
+from bot import Bot
+from dice import trial_dice, trial_stream
+
+
+PHASES = ('roll', 'generation', 'policy', 'application', 'game over')
+
+
+class RandomPolicy:
+    def __init__(self, seed=None):
+        self._random = random.Random(seed)
+
+    def __call__(self, game, turns):
+        return self._random.choice(turns)
+
+
+class FirstPolicy:
+    def __init__(self, seed=None):
+        pass
+
+    def __call__(self, game, turns):
+        return turns[0]
+
+
+POLICIES = {
+    'random': RandomPolicy,
+    'first': FirstPolicy,
+    'bot': Bot
+}
+
+
+class Stats:
+    def __init__(self):
+        self.games = 0
+        self.turns = 0
+        self.moves = 0
+        self.wins = {color.WHITE: 0, color.RED: 0}
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.elapsed = 0.0
+
+    def __str__(self):
+        elapsed = self.elapsed or float('inf')
+        lines = [
+            f'games: {self.games} in {self.elapsed:.3f} s '
+            f'({self.games / elapsed:.1f} games/s)',
+            f'turns: {self.turns}, moves: {self.moves} '
+            f'({self.moves / elapsed:.1f} moves/s)',
+            f'wins: white {self.wins[color.WHITE]}, red {self.wins[color.RED]}'
+        ]
+        for phase, seconds in self.phases.items():
+            share = 100 * seconds / elapsed
+            lines.append(f'{phase:>12}: {seconds:.3f} s ({share:.1f}%)')
+        return '\n'.join(lines)
+
+
+def play_game(white, red, dice, stats=None, game=None):
+    """Play `game` (a new one by default) to the end, return the winner."""
+    stats = stats or Stats()
+    phases = stats.phases
+    clock = time.perf_counter
+    game = game or Backgammon()
+    while True:
+        start = clock()
+        game.roll_dice(dice())
+        rolled = clock()
+        turns = game.possible_turns
+        generated = clock()
+        policy = white if game.color == color.WHITE else red
+        turn = policy(game, turns)
+        chosen = clock()
+        for from_point, to_point in turn:
+            game.move(from_point, to_point)
+        applied = clock()
+        game_over = game.game_over
+        checked = clock()
+        phases['roll'] += rolled - start
+        phases['generation'] += generated - rolled
+        phases['policy'] += chosen - generated
+        phases['application'] += applied - chosen
+        phases['game over'] += checked - applied
+        stats.turns += 1
+        stats.moves += len(turn)
+        if game_over:
+            stats.games += 1
+            stats.wins[game.color] += 1
+            return game.color
+
+
+def simulate(games, white, red, dice):
+    """Play the games, `dice(number)` gives the dice of every game."""
+    stats = Stats()
+    start = time.perf_counter()
+    for number in range(games):
+        play_game(white, red, dice(number), stats)
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--white', choices=POLICIES, default='random')
+    parser.add_argument('--red', choices=POLICIES, default='random')
+    parser.add_argument('--stratify', action='store_true',
+                        help='spread first rolls evenly over the games')
+    parser.add_argument('--antithetic', action='store_true',
+                        help='play games in pairs with mirrored dice')
+    args = parser.parse_args()
+    seeds = random.Random(args.seed)
+    white = POLICIES[args.white](seeds.getrandbits(32))
+    red = POLICIES[args.red](seeds.getrandbits(32))
+    dice_seed = seeds.getrandbits(32)
+
+    def dice(number):
+        stream = trial_stream(number, args.antithetic)
+        return trial_dice(f'{dice_seed}:{stream}', number,
+                          args.stratify, args.antithetic)
+
+    print(simulate(args.games, white, red, dice))
+
+
+if __name__ == '__main__':
+    main()
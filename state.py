@@ -6,6 +6,7 @@ import sys
 import config
 import color
 import backgammon
+import bot
 import component as c
 import graphic as g
 
@@ -26,6 +27,9 @@ class State:
     def start_network_game(self):
         pass
 
+    def start_bot_game(self):
+        pass
+
     def handle_received(self):
         pass
 
@@ -69,13 +73,16 @@ class LockState(State):
         self.client.game.roll_dice()
         self.client.state = LocalPlayingState(self.client)
 
+    def start_bot_game(self):
+        self.client.restart()
+        self.client.game.roll_dice()
+        self.client.state = BotPlayingState(self.client)
+
     def start_network_game(self):
         if not self.client.bgp.closed:
             self.client.bgp.close()
         try:
             self.client.bgp.connect()
-        except socket.timeout:
-            pass
         except (socket.error, ConnectionError) as e:
             self.client.state = DisconnectedState(self.client)
             return
@@ -114,11 +121,13 @@ class PauseState(LockState):
         self.from_state = from_state
 
     def start_local_game(self):
-        if isinstance(self.from_state, NetworkPlayingState):
-            self.client.bgp.send_quit()
-            self.client.bgp.close()
+        self._quit_network_game()
         super().start_local_game()
 
+    def start_bot_game(self):
+        self._quit_network_game()
+        super().start_bot_game()
+
     def set_state_image(self):
         self.from_state.set_state_image()
 
@@ -131,12 +140,21 @@ class PauseState(LockState):
     def close_window(self):
         self.from_state.close_window()
 
+    def _quit_network_game(self):
+        if isinstance(self.from_state, NetworkPlayingState):
+            self.client.bgp.send_quit()
+            self.client.bgp.close()
+
 
 class SearchingOpponentState(LockState):
     def start_local_game(self):
         self.client.bgp.close()
         super().start_local_game()
 
+    def start_bot_game(self):
+        self.client.bgp.close()
+        super().start_bot_game()
+
     def start_network_game(self):
         pass
 
@@ -152,10 +170,6 @@ class SearchingOpponentState(LockState):
             if message['command'] == 'COLOR':
                 self.client.network_game_color = message['arg']
                 self.client.restart()
-                if self.client.network_game_color == color.WHITE:
-                    roll = backgammon.Roll()
-                    self.client.game.roll_dice(roll)
-                    self.client.bgp.send_dies(roll.die1, roll.die2)
                 self.client.state = ViewNetworkColorState(self.client)
         except socket.timeout as e:
             raise e
@@ -199,6 +213,27 @@ class LocalPlayingState(_PlayingState):
         return self.client.game.possible_points
 
 
+class BotPlayingState(LocalPlayingState):
+    """Local game against the computer, which plays red."""
+    def __init__(self, client):
+        super().__init__(client)
+        self.bot = bot.Bot(
+            depth=config.BOT_DEPTH,
+            time_budget=config.BOT_TIME_BUDGET
+        )
+
+    def end_move(self):
+        if self.possible_points:
+            return
+        game = self.client.game
+        game.roll_dice()
+        for from_point, to_point in self.bot(game, game.possible_turns):
+            game.move(from_point, to_point)
+        self._check_win_state()
+        if self.client.state is self:
+            game.roll_dice()
+
+
 class NetworkPlayingState(_PlayingState):
     # . . .
     def move(self, from_point, to_point):
@@ -209,6 +244,8 @@ class NetworkPlayingState(_PlayingState):
         self.client.game.move(from_point, to_point)
         self._check_win_state()
         self.client.bgp.send_move(from_point, to_point)
+        if self.client.game.game_over:
+            self.client.bgp.flush()
 
     def end_move(self):
         if not self.possible_points:
@@ -220,23 +257,34 @@ class NetworkPlayingState(_PlayingState):
             if message['command'] == 'QUIT':
                 self.client.bgp.close()
                 self.client.state = DisconnectedState(self.client)
-            if self.client.network_game_color == self.client.game.color:
-                if message['command'] == 'DIES':
-                    die1, die2 = message['args']
-                    self.client.game.roll_dice(backgammon.Roll(die1, die2))
-            elif self.client.network_game_color != self.client.game.color:
-                if message['command'] == 'MOVE':
-                    from_point, to_point = message['args']
-                    self.client.game.move(from_point, to_point)
-                elif message['command'] == 'ENDMOVE':
-                    roll = backgammon.Roll()
-                    self.client.game.roll_dice(roll)
-                    self.client.bgp.send_dies(roll.die1, roll.die2)
+            elif message['command'] == 'DIES':
+                die1, die2 = message['args']
+                self.client.game.roll_dice(backgammon.Roll(die1, die2))
+            elif (message['command'] == 'MOVE' and
+                    self.client.network_game_color != self.client.game.color):
+                from_point, to_point = message['args']
+                self.client.game.move(from_point, to_point)
             self._check_win_state()
         except socket.timeout as e:
             raise e
         except (socket.error, ConnectionError):
+            self._resume()
+
+    def _resume(self):
+        """Take the seat back on a new connection, or give the game up."""
+        try:
+            snapshot = self.client.bgp.resume()
+        except (socket.error, ConnectionError):
+            snapshot = None
+        if snapshot is None:
             self.client.state = DisconnectedState(self.client)
+            return
+        self.client.network_game_color = snapshot['arg']
+        self.client.restart(snapshot['counts'], snapshot['turn'])
+        game = self.client.game
+        game.roll_dice(backgammon.Roll(*snapshot['args']))
+        for from_point, to_point in snapshot['moves']:
+            game.move(from_point, to_point)
 
     def close_window(self):
         self.client.bgp.send_quit()
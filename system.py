@@ -17,10 +17,12 @@ class NetworkSystem(ecys.System):
         self.client = client
 
     def update(self):
-        try:
-            self.client.state.handle_received()
-        except socket.timeout:
-            pass
+        # Everything received since the last frame, without waiting.
+        for _ in range(self.client.bgp.pending):
+            try:
+                self.client.state.handle_received()
+            except socket.timeout:
+                return
 
 
 @ecys.requires(c.Render, c.Die)
@@ -159,6 +161,7 @@ class InputSystem(ecys.System):
             self._handle_end_move(event)
             self._handle_start_local_game(event)
             self._handle_start_network_game(event)
+            self._handle_start_bot_game(event)
             self._handle_save_history(event)
             self._handle_pause(event)
 
@@ -242,6 +245,10 @@ class InputSystem(ecys.System):
             if net_render.rect.collidepoint(event.pos):
                 self.client.state.start_network_game()
 
+    def _handle_start_bot_game(self, event):
+        if event.type == pygame.KEYUP and event.key == pygame.K_b:
+            self.client.state.start_bot_game()
+
     def _handle_save_history(self, event):
         state_render = self.client.state_button.get_component(c.Render)
         state_button_pressed = (self._button_clicked(event)
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+
+class TranspositionTable:
+    """Bounded cache of search results keyed by `Board.position_hash`.
+
+    The least recently used entry is evicted when the table is full. A
+    stored entry is only replaced by a result of at least the same depth.
+    """
+    def __init__(self, maxsize=1 << 16):
+        assert maxsize > 0, f'Table size must be positive: {maxsize}'
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __repr__(self):
+        return (f'TranspositionTable({len(self)}/{self.maxsize}, '
+                f'hits={self.hits}, misses={self.misses})')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, depth=0, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < depth:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def store(self, key, value, depth=0):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > depth:
+                return
+            self._entries.move_to_end(key)
+        elif len(self._entries) >= self.maxsize:
+            self._entries.popitem(last=False)
+        self._entries[key] = (depth, value)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0